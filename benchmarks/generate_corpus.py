@@ -0,0 +1,206 @@
+"""Generate a synthetic copy of the site for build benchmarks.
+
+The corpus is a copy of the site (conf.py, Makefile, themes, templates,
+plugins, pages, files, galleries and images) whose posts are replaced by N
+synthetic posts, spread evenly across every format of POSTS (.md, .markdown,
+.rst, .html, .ipynb). It also gets a synthetic gallery and a folder of images
+used by the posts. The output only depends on N and the seed.
+
+Usage:
+
+    python benchmarks/generate_corpus.py 1000 /tmp/corpus-1000
+"""
+
+import argparse
+import base64
+import datetime
+import io
+import json
+import os
+import random
+import shutil
+
+from PIL import Image
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Copied from the site as they are; posts are generated instead
+SITE_ITEMS = ('conf.py', 'Makefile', 'themes', 'templates', 'plugins', 'pages', 'files', 'galleries', 'images')
+
+FORMATS = ('md', 'markdown', 'rst', 'html', 'ipynb')
+
+WORDS = (
+    'array', 'api', 'numpy', 'python', 'data', 'compiler', 'kernel', 'notebook', 'gallery',
+    'benchmark', 'dataframe', 'scipy', 'pandas', 'dask', 'library', 'community', 'release',
+    'performance', 'memory', 'index', 'search', 'protocol', 'interop', 'jupyter', 'sparse',
+    'the', 'of', 'and', 'to', 'a', 'in', 'is', 'for', 'with', 'on', 'that', 'by', 'this',
+)
+TAGS = ('NumPy', 'SciPy', 'Jupyter', 'Array API', 'pandas', 'Dask', 'Ibis', 'conda', 'PyTorch', 'Packaging')
+CODE = '''def mean(values):
+    """Return the mean of values."""
+    total = 0
+    for value in values:
+        total += value
+    return total / len(values)
+'''
+START_DATE = datetime.datetime(2019, 1, 1, 9, 0, 0)
+
+
+def sentence(rng, words=12):
+    text = ' '.join(rng.choice(WORDS) for _ in range(words))
+    return text[0].upper() + text[1:] + '.'
+
+
+def paragraph(rng):
+    return ' '.join(sentence(rng, rng.randint(8, 20)) for _ in range(rng.randint(3, 7)))
+
+
+def make_image(rng, path, size):
+    """Write a PNG of random colored stripes."""
+    image = Image.new('RGB', size)
+    width, height = size
+    x = 0
+    while x < width:
+        stripe = rng.randint(8, 64)
+        color = (rng.randrange(256), rng.randrange(256), rng.randrange(256))
+        image.paste(color, (x, 0, min(x + stripe, width), height))
+        x += stripe
+    image.save(path)
+
+
+def png_data(rng):
+    """Return a small PNG, base64 encoded, as found in notebook outputs."""
+    buffer = io.BytesIO()
+    image = Image.new('RGB', (160, 120), (rng.randrange(256), rng.randrange(256), rng.randrange(256)))
+    image.save(buffer, 'PNG')
+    return base64.b64encode(buffer.getvalue()).decode('ascii')
+
+
+def post_metadata(index, rng):
+    date = START_DATE + datetime.timedelta(hours=7 * index)
+    return {
+        'title': 'Synthetic post {0}: {1}'.format(index, sentence(rng, 5)[:-1]),
+        'slug': 'synthetic-post-{0}'.format(index),
+        'date': date.strftime('%Y-%m-%d %H:%M:%S UTC+00:00'),
+        'author': 'Benchmark Bot',
+        'tags': ', '.join(sorted(set(rng.choice(TAGS) for _ in range(3)))),
+    }
+
+
+def write_post(folder, index, fmt, rng, images):
+    """Write post number index in the given format, return its path."""
+    meta = post_metadata(index, rng)
+    paragraphs = [paragraph(rng) for _ in range(rng.randint(4, 12))]
+    image = '/images/bench/{0}'.format(images[index % len(images)]) if index % 10 == 0 else None
+    path = os.path.join(folder, '{0}.{1}'.format(meta['slug'], fmt))
+    header = ''.join('.. {0}: {1}\n'.format(key, value) for key, value in meta.items())
+    if fmt in ('md', 'markdown'):
+        body = ['## ' + sentence(rng, 4)[:-1]] + paragraphs[:2]
+        body.append('```python\n' + CODE + '```')
+        body.append('See [the project](https://labs.quansight.org/) for more.')
+        if image:
+            body.append('![Synthetic image]({0})'.format(image))
+        body += paragraphs[2:]
+        content = '<!--\n' + header + '.. type: text\n-->\n\n' + '\n\n'.join(body) + '\n'
+    elif fmt == 'rst':
+        title = sentence(rng, 4)[:-1]
+        body = [title + '\n' + '-' * len(title)] + paragraphs[:2]
+        body.append('.. code-block:: python\n\n' + ''.join('    ' + line + '\n' for line in CODE.splitlines()))
+        body.append('See `the project <https://labs.quansight.org/>`_ for more.')
+        if image:
+            body.append('.. image:: {0}\n   :alt: Synthetic image'.format(image))
+        body += paragraphs[2:]
+        content = header + '.. type: text\n\n' + '\n\n'.join(body) + '\n'
+    elif fmt == 'html':
+        body = ['<h2>{0}</h2>'.format(sentence(rng, 4)[:-1])] + ['<p>{0}</p>'.format(p) for p in paragraphs[:2]]
+        body.append('<pre class="code"><code>{0}</code></pre>'.format(CODE))
+        if image:
+            body.append('<img src="{0}" alt="Synthetic image">'.format(image))
+        body += ['<p>{0}</p>'.format(p) for p in paragraphs[2:]]
+        content = '<!--\n' + header + '.. type: text\n-->\n\n' + '\n'.join(body) + '\n'
+    else:
+        cells = [{'cell_type': 'markdown', 'metadata': {}, 'source': '## ' + sentence(rng, 4)[:-1] + '\n\n' + p}
+                 for p in paragraphs[:2]]
+        outputs = [{'name': 'stdout', 'output_type': 'stream', 'text': sentence(rng) + '\n'}]
+        if index % 5 == 4:
+            outputs.append({'data': {'image/png': png_data(rng), 'text/plain': '<Figure>'},
+                            'metadata': {}, 'output_type': 'display_data'})
+        cells.append({'cell_type': 'code', 'execution_count': 1, 'metadata': {}, 'outputs': outputs,
+                      'source': CODE + 'print(mean([1, 2, 3]))'})
+        cells += [{'cell_type': 'markdown', 'metadata': {}, 'source': p} for p in paragraphs[2:]]
+        notebook = {
+            'cells': cells,
+            'metadata': {
+                'kernelspec': {'display_name': 'Python 3', 'language': 'python', 'name': 'python3'},
+                'language_info': {'name': 'python', 'pygments_lexer': 'ipython3'},
+                'nikola': meta,
+            },
+            'nbformat': 4,
+            'nbformat_minor': 4,
+        }
+        content = json.dumps(notebook, indent=1, sort_keys=True) + '\n'
+    with io.open(path, 'w', encoding='utf-8') as fd:
+        fd.write(content)
+    return path
+
+
+def copy_site(dest):
+    """Copy the parts of the site needed to build it, hard-linking files when possible."""
+    def link_or_copy(src, dst):
+        try:
+            os.link(src, dst)
+        except OSError:
+            shutil.copy2(src, dst)
+
+    for item in SITE_ITEMS:
+        src = os.path.join(ROOT, item)
+        if os.path.isdir(src):
+            shutil.copytree(src, os.path.join(dest, item), copy_function=link_or_copy,
+                            ignore=shutil.ignore_patterns('__pycache__'))
+        else:
+            shutil.copy2(src, os.path.join(dest, item))
+
+
+def generate(size, dest, seed=0):
+    """Generate a corpus of size posts in dest (which must not exist).
+
+    Returns the list of generated post paths, in order.
+    """
+    rng = random.Random(seed)
+    os.makedirs(dest)
+    copy_site(dest)
+
+    images = []
+    image_folder = os.path.join(dest, 'images', 'bench')
+    os.makedirs(image_folder)
+    for i in range(20):
+        name = 'bench-{0}.png'.format(i)
+        make_image(rng, os.path.join(image_folder, name), (rng.randint(600, 1600), rng.randint(400, 900)))
+        images.append(name)
+    gallery = os.path.join(dest, 'galleries', 'bench')
+    os.makedirs(gallery)
+    for i in range(max(10, size // 100)):
+        make_image(rng, os.path.join(gallery, 'photo-{0}.png'.format(i)), (800, 600))
+
+    paths = []
+    for index in range(size):
+        fmt = FORMATS[index % len(FORMATS)]
+        folder = os.path.join(dest, 'posts', 'bench', fmt, str(index // 500))
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        paths.append(write_post(folder, index, fmt, random.Random(seed * 1000003 + index), images))
+    return paths
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('size', type=int, help='number of posts')
+    parser.add_argument('dest', help='folder to create the corpus in')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    paths = generate(args.size, args.dest, args.seed)
+    print('Generated {0} posts in {1}'.format(len(paths), args.dest))
+
+
+if __name__ == '__main__':
+    main()
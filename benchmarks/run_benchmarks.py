@@ -0,0 +1,158 @@
+"""Benchmark the site build on synthetic corpora.
+
+For each corpus size, a corpus is generated (see generate_corpus.py) and
+``make build`` is timed three times:
+
+* cold: first build, without output or cache;
+* warm: a second build without changes;
+* incremental: a build after editing one Markdown post.
+
+Wall time, user and system CPU time and the peak RSS of the build are
+recorded. Results are written to benchmarks/results/<timestamp>-<commit>.json
+after each corpus size, so an interrupted run keeps the sizes it finished. The
+folder is ignored by git so that results of different commits can be kept
+side by side and compared:
+
+    python benchmarks/run_benchmarks.py --sizes 100 1000
+    python benchmarks/run_benchmarks.py --compare results/old.json results/new.json
+"""
+
+import argparse
+import datetime
+import io
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import generate_corpus
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+RESULTS = os.path.join(HERE, 'results')
+PHASES = ('cold', 'warm', 'incremental')
+
+
+def run_build(corpus, jobs):
+    """Run make build in a corpus, returning its measures."""
+    command = ['make', 'build']
+    if jobs:
+        command.append('JOBS={0}'.format(jobs))
+    env = dict(os.environ)
+    # Use the nikola of the running Python environment
+    env['PATH'] = os.path.dirname(sys.executable) + os.pathsep + env.get('PATH', '')
+    with io.open(os.path.join(corpus, 'build.log'), 'ab') as log:
+        start = time.perf_counter()
+        process = subprocess.Popen(command, cwd=corpus, env=env, stdout=log, stderr=subprocess.STDOUT)
+        # wait4 gives the resource usage of the build and everything it waited for
+        _, status, usage = os.wait4(process.pid, 0)
+        wall = time.perf_counter() - start
+    process.returncode = os.waitstatus_to_exitcode(status) if hasattr(os, 'waitstatus_to_exitcode') else status >> 8
+    if process.returncode:
+        raise RuntimeError('{0} failed in {1}, see build.log'.format(' '.join(command), corpus))
+    return {
+        'wall': wall,
+        'user': usage.ru_utime,
+        'sys': usage.ru_stime,
+        'max_rss_kb': usage.ru_maxrss,
+    }
+
+
+def edit_post(path):
+    """Append a paragraph to a post."""
+    with io.open(path, 'a', encoding='utf-8') as fd:
+        fd.write('\nThis paragraph was added by the incremental benchmark.\n')
+
+
+def benchmark(size, workdir, jobs, seed):
+    corpus = os.path.join(workdir, 'corpus-{0}'.format(size))
+    if os.path.exists(corpus):
+        shutil.rmtree(corpus)
+    start = time.perf_counter()
+    paths = generate_corpus.generate(size, corpus, seed)
+    results = {'generate': time.perf_counter() - start}
+    for phase in PHASES:
+        if phase == 'incremental':
+            edit_post(next(path for path in paths if path.endswith('.md')))
+        results[phase] = run_build(corpus, jobs)
+        print('{0:>6} posts {1:>12}: {2:8.1f}s wall {3:8.1f} MiB'.format(
+            size, phase, results[phase]['wall'], results[phase]['max_rss_kb'] / 1024.0))
+    return results
+
+
+def git_commit():
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=HERE).decode().strip()
+        dirty = subprocess.call(['git', 'diff', '--quiet', 'HEAD'], cwd=HERE) != 0
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+    return commit + ('-dirty' if dirty else '')
+
+
+def write_report(path, report):
+    """Write the results, replacing those of the previous sizes."""
+    tmp_path = path + '.tmp'
+    with io.open(tmp_path, 'w', encoding='utf-8') as fd:
+        json.dump(report, fd, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def compare(old_path, new_path):
+    """Print the change of every measure between two result files."""
+    with io.open(old_path, encoding='utf-8') as fd:
+        old = json.load(fd)
+    with io.open(new_path, encoding='utf-8') as fd:
+        new = json.load(fd)
+    print('{0} ({1}) -> {2} ({3})'.format(old['commit'], old['date'], new['commit'], new['date']))
+    print('{0:>6} {1:>12} {2:>10} {3:>10} {4:>8} {5:>10} {6:>10}'.format(
+        'posts', 'phase', 'old wall', 'new wall', 'change', 'old MiB', 'new MiB'))
+    for size in sorted(set(old['results']) & set(new['results']), key=int):
+        for phase in PHASES:
+            a, b = old['results'][size][phase], new['results'][size][phase]
+            print('{0:>6} {1:>12} {2:>9.1f}s {3:>9.1f}s {4:>+7.1f}% {5:>10.1f} {6:>10.1f}'.format(
+                size, phase, a['wall'], b['wall'], 100.0 * (b['wall'] - a['wall']) / a['wall'],
+                a['max_rss_kb'] / 1024.0, b['max_rss_kb'] / 1024.0))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 10000])
+    parser.add_argument('--jobs', type=int, help='parallel build processes (default: one per core)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workdir', help='where corpora are generated (default: a temporary folder)')
+    parser.add_argument('--keep', action='store_true', help='keep the corpora after the run')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='compare two result files')
+    args = parser.parse_args()
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='labs-bench-')
+    report = {
+        'commit': git_commit(),
+        'date': datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'jobs': args.jobs,
+        'seed': args.seed,
+        'results': {},
+    }
+    if not os.path.isdir(RESULTS):
+        os.makedirs(RESULTS)
+    path = os.path.join(RESULTS, '{0}-{1}.json'.format(report['date'].replace(':', ''), report['commit']))
+    try:
+        for size in args.sizes:
+            report['results'][str(size)] = benchmark(size, workdir, args.jobs, args.seed)
+            write_report(path, report)
+            print('Results written to {0}'.format(path))
+    finally:
+        if not args.keep and not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
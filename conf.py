@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 
+import os
 import time
 
 # !! This is the configuration of Nikola. !! #
@@ -618,6 +619,24 @@ GITHUB_COMMIT_SOURCE = False
 #    ".jpg": ["jpegoptim --strip-all -m75 -v %s"],
 # }
 
+# Serve resized WebP/AVIF variants of IMAGE_FOLDERS images through <picture>
+# (see plugins/responsive_images), inline the critical CSS of pages (see
+# plugins/critical_css), and point pages to content hashed copies of the assets
+# (see plugins/fingerprint_assets). Text files get .gz and .br copies (see
+# plugins/precompress): assets before fingerprint_assets copies them, pages
+# once they are final.
+PRECOMPRESS_EXTENSIONS = ['.html', '.js', '.css', '.json', '.xml', '.svg', '.txt']
+FINGERPRINT_EXTENSIONS = ['.css', '.js', '.json', '.png', '.jpg', '.jpeg', '.gif', '.svg', '.webp', '.avif']
+FILTERS = {
+    ".html": ["responsive_images", "critical_css", "fingerprint_assets", "precompress"],
+}
+FILTERS.update((ext, ["fingerprint_assets"]) for ext in FINGERPRINT_EXTENSIONS)
+for ext in PRECOMPRESS_EXTENSIONS:
+    if ext != ".html":
+        FILTERS.setdefault(ext, []).insert(0, "precompress")
+# Asset folders copied to the output by plugins, hashed like FILES_FOLDERS.
+FINGERPRINT_SOURCE_FOLDERS = {'plugins/localsearch/localsearch/files': ''}
+
 # Executable for the "yui_compressor" filter (defaults to 'yui-compressor').
 # YUI_COMPRESSOR_EXECUTABLE = 'yui-compressor'
 
@@ -742,6 +761,10 @@ IMAGE_FOLDERS = {'images': 'images'}
 IMAGE_THUMBNAIL_SIZE = 400
 # IMAGE_THUMBNAIL_FORMAT = '{name}.thumbnail{ext}'
 
+# Widths and formats of the variants written by the responsive_images plugin.
+RESPONSIVE_IMAGE_WIDTHS = [480, 960]
+RESPONSIVE_IMAGE_FORMATS = ['avif', 'webp']
+
 # #############################################################################
 # HTML fragments and diverse things that are used by the templates
 # #############################################################################
@@ -1221,6 +1244,17 @@ TWITTER_CARD = {
 # USE_BUNDLES = True
 
 
+# Options passed to doit, the task runner behind "nikola build".
+# Tasks are run in parallel worker processes, one per core by default;
+# set NIKOLA_JOBS or use "nikola build -n N" to change that.  Every task
+# writes its own files and the generated indexes, feeds and sitemaps are
+# sorted, so the output does not depend on the order tasks finish in.
+DOIT_CONFIG = {
+    'num_process': int(os.environ.get('NIKOLA_JOBS', os.cpu_count() or 1)),
+    'par_type': 'process',
+}
+
+
 # Plugins you don't want to use. Be careful :-)
 # DISABLED_PLUGINS = ["render_galleries"]
 
@@ -1309,4 +1343,12 @@ EXTRA_HEAD_DATA += """
 <link rel="stylesheet" type="text/css" href="/assets/css/tipuesearch.css">
 """
 
+# Ship a compact inverted index instead of the full text of every post
+LOCALSEARCH_INVERTED_INDEX = True
+
 CREATE_HTTP_ERROR_PAGES = [404]
+
+# precompress: write .gz and .br copies of text files larger than 1 KiB (the
+# filter is enabled in FILTERS)
+PRECOMPRESS_FORMATS = ['gz', 'br']
+PRECOMPRESS_MIN_SIZE = 1024
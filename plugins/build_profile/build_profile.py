@@ -0,0 +1,308 @@
+# -*- coding: utf-8 -*-
+
+# Copyright © 2022 Quansight Labs and others.
+
+# Permission is hereby granted, free of charge, to any
+# person obtaining a copy of this software and associated
+# documentation files (the "Software"), to deal in the
+# Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the
+# Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice
+# shall be included in all copies or substantial portions of
+# the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY
+# KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+# WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR
+# PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS
+# OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+# OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+# OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""Record the time and memory used by every task and plugin of a build."""
+
+import codecs
+import contextlib
+import json
+import os
+import shutil
+import time
+from collections import Counter, OrderedDict
+
+try:
+    import resource
+except ImportError:
+    resource = None  # NOQA
+
+from blinker import signal
+from doit.reporter import ExecutedOnlyReporter
+from doit.runner import Runner
+
+from nikola.plugin_categories import ConfigPlugin
+from nikola.utils import makedirs
+
+REPORT_NAME = 'build_profile.json'
+TRACE_NAME = 'build_profile.trace.json'
+# Records of the tasks run by worker processes, one file per worker
+WORKERS_FOLDER = 'build_profile'
+
+
+def cpu_time():
+    """Return the CPU time used by this process and its finished children."""
+    if resource is None:
+        return time.process_time()
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime + children.ru_utime + children.ru_stime
+
+
+def peak_rss():
+    """Return the peak resident set size of this process and its finished children, in KiB (0 if unknown).
+
+    This is a high-water mark over the whole life of the processes, not a
+    measure of the running task.
+    """
+    if resource is None:
+        return 0
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+
+def current_rss():
+    """Return the current resident set size of this process, in KiB (None if unknown)."""
+    try:
+        with open('/proc/self/statm') as fd:
+            pages = int(fd.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return None
+    return pages * os.sysconf('SC_PAGE_SIZE') // 1024
+
+
+class ProfileReporter(ExecutedOnlyReporter):
+    """doit reporter passing up-to-date tasks and the end of the build to the build profiler."""
+
+    profiler = None
+
+    def skip_uptodate(self, task):
+        self.profiler.skip_task(task.name)
+        super().skip_uptodate(task)
+
+    def complete_run(self):
+        super().complete_run()
+        self.profiler.write_report()
+
+
+class BuildProfile(ConfigPlugin):
+    """Record wall time, CPU time and memory per task and per plugin.
+
+    Enabled by ``BUILD_PROFILE = True`` or the ``NIKOLA_PROFILE`` environment
+    variable. doit tasks are timed in the process running them, by wrapping
+    the doit runner; compilers, the template system, shortcodes and reST
+    directives of plugins are wrapped to time each call. The build keeps its
+    configured number of processes: worker processes run one task at a time,
+    and hand their records over through files in the cache folder.
+    """
+
+    name = "build_profile"
+
+    def set_site(self, site):
+        super().set_site(site)
+        self.enabled = bool(os.environ.get('NIKOLA_PROFILE') or site.config.get('BUILD_PROFILE', False))
+        if not self.enabled:
+            return
+        self.origin = time.perf_counter()
+        self.origin_cpu = cpu_time()
+        self.pid = os.getpid()
+        self.workers_folder = os.path.join(site.config['CACHE_FOLDER'], WORKERS_FOLDER)
+        if os.path.isdir(self.workers_folder):
+            shutil.rmtree(self.workers_folder)
+        self.tasks = []
+        self.spans = []
+        self.skipped = Counter()
+        self._running = None
+        self._depth = Counter()
+        ProfileReporter.profiler = self
+        site._doit_config['reporter'] = ProfileReporter
+        self._wrap_runner()
+        signal('initialized').connect(self._instrument)
+
+    def _wrap_runner(self):
+        """Time every task in the process executing it, worker processes included."""
+        profiler = self
+        execute_task = Runner.execute_task
+
+        def profiled_execute_task(runner, task):
+            profiler.start_task(task.name)
+            failure = None
+            try:
+                failure = execute_task(runner, task)
+                return failure
+            finally:
+                profiler.end_task(task.name, 'success' if failure is None else 'failure')
+
+        Runner.execute_task = profiled_execute_task
+
+    def _timed(self, function, label):
+        """Return a version of a function recording a span for every call."""
+        def timed(*args, **kwargs):
+            with self.span(label):
+                return function(*args, **kwargs)
+        return timed
+
+    def _instrument(self, site):
+        """Wrap the entry points of plugins running inside tasks."""
+        for name, compiler in site.compilers.items():
+            for method in ('compile', 'compile_string'):
+                setattr(compiler, method, self._timed(getattr(compiler, method), 'compiler:' + name))
+        site.template_system.render_template = self._timed(
+            site.template_system.render_template, 'template:' + site.template_system.name)
+        for name, function in list(site.shortcode_registry.items()):
+            site.shortcode_registry[name] = self._timed(function, 'shortcode:' + name)
+        # reST directives defined by plugins, such as gallery_directive
+        from docutils.parsers.rst import directives
+        for plugin_info in site.plugin_manager.getPluginsOfCategory('RestExtension'):
+            module = plugin_info.plugin_object.__class__.__module__
+            for directive in set(directives._directives.values()):
+                if isinstance(directive, type) and directive.__module__ == module:
+                    directive.run = self._timed(directive.run, plugin_info.name)
+
+    @contextlib.contextmanager
+    def span(self, label):
+        """Record the time spent in a block as a span of the running task.
+
+        Recursive spans (e.g. compile calling compile_string) are kept in the
+        trace but only the outermost one counts in the totals.
+        """
+        nested = self._depth[label] > 0
+        self._depth[label] += 1
+        start, start_cpu = time.perf_counter(), cpu_time()
+        try:
+            yield
+        finally:
+            self._depth[label] -= 1
+            self.spans.append({
+                'name': label,
+                'task': self._running[0] if self._running else None,
+                'pid': os.getpid(),
+                'start': start - self.origin,
+                'wall': time.perf_counter() - start,
+                'cpu': cpu_time() - start_cpu,
+                'nested': nested,
+            })
+
+    def start_task(self, name):
+        self._running = (name, time.perf_counter(), cpu_time(), current_rss())
+
+    def end_task(self, name, status):
+        _, start, start_cpu, start_rss = self._running
+        self._running = None
+        rss = current_rss()
+        self.tasks.append({
+            'name': name,
+            'plugin': name.split(':', 1)[0],
+            'status': status,
+            'pid': os.getpid(),
+            'start': start - self.origin,
+            'wall': time.perf_counter() - start,
+            'cpu': cpu_time() - start_cpu,
+            'rss_kb': rss,
+            'rss_delta_kb': None if rss is None or start_rss is None else rss - start_rss,
+            'cumulative_peak_rss_kb': peak_rss(),
+        })
+        if os.getpid() != self.pid:
+            self._hand_over()
+
+    def _hand_over(self):
+        """Append the records of a worker process to its file, for the main process to merge."""
+        makedirs(self.workers_folder)
+        with codecs.open(os.path.join(self.workers_folder, '{0}.jsonl'.format(os.getpid())), 'a', 'utf8') as fd:
+            for kind in ('tasks', 'spans'):
+                for record in getattr(self, kind):
+                    fd.write(json.dumps([kind, record]) + '\n')
+        self.tasks, self.spans = [], []
+
+    def _merge_workers(self):
+        """Add the records of worker processes to those of this process."""
+        if not os.path.isdir(self.workers_folder):
+            return
+        for fname in sorted(os.listdir(self.workers_folder)):
+            with codecs.open(os.path.join(self.workers_folder, fname), 'r', 'utf8') as fd:
+                for line in fd:
+                    kind, record = json.loads(line)
+                    getattr(self, kind).append(record)
+        shutil.rmtree(self.workers_folder)
+
+    def skip_task(self, name):
+        self.skipped[name.split(':', 1)[0]] += 1
+
+    def _plugin_totals(self):
+        """Sum the measures of tasks per plugin, and of spans per label."""
+        plugins = {}
+
+        def add(label, record, key):
+            totals = plugins.setdefault(label, OrderedDict(
+                [('wall', 0.0), ('cpu', 0.0), ('tasks', 0), ('calls', 0), ('uptodate', 0)]))
+            totals['wall'] += record['wall']
+            totals['cpu'] += record['cpu']
+            totals[key] += 1
+
+        for record in self.tasks:
+            add(record['plugin'], record, 'tasks')
+        for record in self.spans:
+            if not record['nested']:
+                add(record['name'], record, 'calls')
+        for label, count in self.skipped.items():
+            plugins.setdefault(label, OrderedDict(
+                [('wall', 0.0), ('cpu', 0.0), ('tasks', 0), ('calls', 0), ('uptodate', 0)]))['uptodate'] = count
+        return OrderedDict(sorted(plugins.items(), key=lambda item: -item[1]['wall']))
+
+    def write_report(self):
+        """Write the JSON report and the trace into the output folder."""
+        output_folder = self.site.config['OUTPUT_FOLDER']
+        self._merge_workers()
+        first_task = min((t['start'] for t in self.tasks), default=time.perf_counter() - self.origin)
+        report = OrderedDict([
+            ('total', OrderedDict([
+                ('wall', time.perf_counter() - self.origin),
+                ('cpu', cpu_time() - self.origin_cpu),
+                ('load', first_task),
+                ('cumulative_peak_rss_kb', peak_rss()),
+                ('processes', len(set(t['pid'] for t in self.tasks))),
+                ('tasks', len(self.tasks)),
+                ('uptodate', sum(self.skipped.values())),
+            ])),
+            ('plugins', self._plugin_totals()),
+            ('tasks', sorted(self.tasks, key=lambda t: -t['wall'])),
+        ])
+        # Chrome trace event format, shown as a flame chart by
+        # chrome://tracing, https://ui.perfetto.dev or https://speedscope.app
+        # One row per process running tasks
+        pid = self.pid
+        events = [{
+            'name': 'load tasks', 'cat': 'build', 'ph': 'X', 'pid': pid, 'tid': pid,
+            'ts': 0, 'dur': int(first_task * 1e6),
+        }]
+        for record in self.tasks:
+            events.append({
+                'name': record['name'], 'cat': record['plugin'], 'ph': 'X', 'pid': pid, 'tid': record['pid'],
+                'ts': int(record['start'] * 1e6), 'dur': int(record['wall'] * 1e6),
+                'args': {'cpu': record['cpu'], 'rss_kb': record['rss_kb'], 'rss_delta_kb': record['rss_delta_kb']},
+            })
+        for record in self.spans:
+            events.append({
+                'name': record['name'], 'cat': 'plugin', 'ph': 'X', 'pid': pid, 'tid': record['pid'],
+                'ts': int(record['start'] * 1e6), 'dur': int(record['wall'] * 1e6),
+                'args': {'cpu': record['cpu'], 'task': record['task']},
+            })
+        makedirs(output_folder)
+        with codecs.open(os.path.join(output_folder, REPORT_NAME), 'w+', 'utf8') as fd:
+            json.dump(report, fd, indent=2)
+        with codecs.open(os.path.join(output_folder, TRACE_NAME), 'w+', 'utf8') as fd:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, fd)
+        self.logger.info("Build profile written to {0}".format(os.path.join(output_folder, REPORT_NAME)))
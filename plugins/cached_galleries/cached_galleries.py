@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+
+# Copyright © 2022 Quansight Labs and others.
+
+# Permission is hereby granted, free of charge, to any
+# person obtaining a copy of this software and associated
+# documentation files (the "Software"), to deal in the
+# Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the
+# Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice
+# shall be included in all copies or substantial portions of
+# the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY
+# KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+# WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR
+# PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS
+# OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+# OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+# OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""Nikola's galleries, with a content-addressed cache of resized images."""
+
+import hashlib
+import json
+import os
+import tempfile
+
+from nikola.plugins.task import galleries
+from nikola import utils
+
+SVG_EXTENSIONS = ('.svg', '.svgz')
+
+
+class CachedGalleries(galleries.Galleries):
+    """Render galleries, reusing resized images from a cache keyed by content.
+
+    This replaces the builtin render_galleries plugin, which has the same name.
+    """
+
+    def set_site(self, site):
+        super().set_site(site)
+        self.kw['image_cache_folder'] = site.config.get(
+            'GALLERY_IMAGE_CACHE_FOLDER', os.path.join(site.config['CACHE_FOLDER'], 'galleries'))
+
+    def _resize_settings(self):
+        """Return a digest of the settings that affect resized images."""
+        settings = {
+            'preserve_exif_data': self.kw['preserve_exif_data'],
+            'exif_whitelist': self.kw['exif_whitelist'],
+            'preserve_icc_profiles': self.kw['preserve_icc_profiles'],
+        }
+        return json.dumps(settings, sort_keys=True)
+
+    def cached_resize(self, src, dst_paths, max_sizes):
+        """Copy resized versions of an image from the cache, resizing on a miss.
+
+        SVG images are copied as they are, browsers scale them just fine.
+        """
+        ext = os.path.splitext(src)[1]
+        if ext.lower() in SVG_EXTENSIONS:
+            for dst in dst_paths:
+                utils.copy_file(src, dst)
+            return
+
+        with open(src, 'rb') as fd:
+            digest = hashlib.sha1(fd.read())
+        digest.update(self._resize_settings().encode('utf-8'))
+        digest = digest.hexdigest()
+        cache_dir = os.path.join(self.kw['image_cache_folder'], digest[:2])
+        cached_paths = [os.path.join(cache_dir, '{0}.{1}{2}'.format(digest, size, ext)) for size in max_sizes]
+
+        missing = [(path, size) for path, size in zip(cached_paths, max_sizes) if not os.path.exists(path)]
+        if missing:
+            utils.makedirs(cache_dir)
+            # Resize to unique temporary names, so interrupted or concurrent
+            # builds leave no broken entries
+            tmp_paths = []
+            for _ in missing:
+                handle, tmp_path = tempfile.mkstemp(suffix=ext, dir=cache_dir)
+                os.close(handle)
+                tmp_paths.append(tmp_path)
+            try:
+                self.resize_image(
+                    src, dst_paths=tmp_paths, max_sizes=[size for _, size in missing],
+                    bigger_panoramas=True, preserve_exif_data=self.kw['preserve_exif_data'],
+                    exif_whitelist=self.kw['exif_whitelist'], preserve_icc_profiles=self.kw['preserve_icc_profiles'])
+                for tmp_path, (path, _) in zip(tmp_paths, missing):
+                    os.replace(tmp_path, path)
+            finally:
+                for tmp_path in tmp_paths:
+                    if os.path.exists(tmp_path):
+                        os.unlink(tmp_path)
+
+        for cached, dst in zip(cached_paths, dst_paths):
+            utils.copy_file(cached, dst)
+
+    def create_target_images(self, img, input_path):
+        """Copy images to output, resized through the cache."""
+        gallery_name = os.path.dirname(img)
+        output_gallery = os.path.dirname(
+            os.path.join(
+                self.kw["output_folder"],
+                self.site.path("gallery_global", gallery_name)))
+        img_name = os.path.basename(img)
+        fname, ext = os.path.splitext(img_name)
+        thumb_path = os.path.join(output_gallery, ".thumbnail".join([fname, ext]))
+        orig_dest_path = os.path.join(output_gallery, img_name)
+        yield utils.apply_filters({
+            'basename': self.name,
+            'name': orig_dest_path,
+            'file_dep': [img],
+            'targets': [thumb_path, orig_dest_path],
+            'actions': [
+                (self.cached_resize, [img, [thumb_path, orig_dest_path],
+                                      [self.kw['thumbnail_size'], self.kw['max_image_size']]])],
+            'clean': True,
+            'uptodate': [utils.config_changed({
+                1: self.kw['thumbnail_size'],
+                2: self.kw['max_image_size'],
+                3: self._resize_settings(),
+            }, 'cached_galleries:resize')],
+        }, self.kw['filters'])
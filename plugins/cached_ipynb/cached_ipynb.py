@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+
+# Copyright © 2022 Quansight Labs and others.
+
+# Permission is hereby granted, free of charge, to any
+# person obtaining a copy of this software and associated
+# documentation files (the "Software"), to deal in the
+# Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the
+# Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice
+# shall be included in all copies or substantial portions of
+# the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY
+# KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+# WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR
+# PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS
+# OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+# OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+# OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""Nikola's ipynb compiler, with a render cache keyed by notebook content."""
+
+import base64
+import codecs
+import copy
+import hashlib
+import html
+import json
+import os
+import tempfile
+
+try:
+    import nbconvert
+    import pygments
+    from nbconvert.exporters import HTMLExporter
+    from nbformat import NotebookNode
+    from traitlets.config import Config
+except ImportError:
+    nbconvert = None  # NOQA
+
+from nikola.plugins.compile import ipynb
+from nikola.utils import makedirs
+
+# Cell and notebook metadata that can change how a notebook is rendered;
+# everything else (collapsed, scrolled, timings, widget state...) is noise.
+CELL_METADATA = ('tags',)
+NOTEBOOK_METADATA = ('kernelspec', 'language_info')
+# Outputs written to separate files, with the extension of these files
+EXTERNAL_OUTPUTS = (
+    ('image/png', '.png'),
+    ('image/jpeg', '.jpg'),
+    ('image/gif', '.gif'),
+    ('image/svg+xml', '.svg'),
+)
+
+
+def normalize_notebook(nb):
+    """Return a copy of a notebook without the fields that do not affect its content.
+
+    Execution counts are dropped as well: the prompts showing them are hidden
+    by the theme, and keeping them would make every re-run of a notebook look
+    like a change.
+    """
+    nb = copy.deepcopy(nb)
+    nb['metadata'] = {k: v for k, v in nb.get('metadata', {}).items() if k in NOTEBOOK_METADATA}
+    for cell in nb.get('cells', []):
+        cell.pop('id', None)
+        cell['metadata'] = {k: v for k, v in cell.get('metadata', {}).items() if k in CELL_METADATA}
+        if 'execution_count' in cell:
+            cell['execution_count'] = None
+        for output in cell.get('outputs', []):
+            if 'execution_count' in output:
+                output['execution_count'] = None
+    return nb
+
+
+def write_file(path, content):
+    """Write bytes to path through a temporary file of its own.
+
+    Parallel builds may write the same file, each replaces it whole.
+    """
+    makedirs(os.path.dirname(path))
+    handle, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(path))
+    try:
+        with os.fdopen(handle, 'wb') as fd:
+            fd.write(content)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+
+
+def externalize_outputs(nb, store, url_prefix, min_size):
+    """Move the image outputs of a notebook into files, in place.
+
+    Every image output of at least min_size bytes is written to the store
+    folder, named after the hash of its content, and replaced with an HTML
+    output loading it lazily from url_prefix. Identical images, in the same
+    or in different notebooks, share a single file. Images are decorative
+    (empty alt) unless their output metadata has an ``alt`` description: the
+    text/plain output is a repr like ``<Figure size 432x288 with 1 Axes>``.
+    """
+    for cell in nb.get('cells', []):
+        for output in cell.get('outputs', []):
+            data = output.get('data', {})
+            for mime, ext in EXTERNAL_OUTPUTS:
+                if mime not in data:
+                    continue
+                if mime == 'image/svg+xml':
+                    content = data[mime].encode('utf-8')
+                else:
+                    content = base64.b64decode(data[mime])
+                if len(content) < min_size:
+                    break
+                name = hashlib.sha1(content).hexdigest()[:16] + ext
+                path = os.path.join(store, name)
+                if not os.path.exists(path):
+                    # Notebooks compiled in parallel may share an image
+                    write_file(path, content)
+                attrs = ['src="{0}/{1}"'.format(url_prefix, name), 'loading="lazy"']
+                metadata = output.get('metadata', {}).get(mime, {})
+                for key in ('width', 'height'):
+                    if key in metadata:
+                        attrs.append('{0}="{1}"'.format(key, html.escape(str(metadata[key]))))
+                attrs.append('alt="{0}"'.format(html.escape(str(metadata.get('alt', '')))))
+                output['data'] = NotebookNode({'text/html': '<img {0}>'.format(' '.join(attrs))})
+                break
+
+
+class CompileCachedIPynb(ipynb.CompileIPynb):
+    """Compile notebooks into HTML, reusing cached renders of unchanged notebooks.
+
+    This replaces the builtin ipynb compiler, which has the same name.
+    """
+
+    # Bump when the format or the content of the render cache changes
+    cache_version = 3
+
+    def set_site(self, site):
+        super().set_site(site)
+        # Compiled posts are outdated when the renders change
+        self.config_dependencies = ['cached_ipynb:{0}'.format(self.cache_version)]
+
+    def _exporter(self):
+        """Return the HTML exporter and a digest of its configuration."""
+        if getattr(self, '_exporter_cache', None) is None:
+            c = Config(ipynb.get_default_jupyter_config())
+            c.merge(Config(self.site.config['IPYNB_CONFIG']))
+            if 'template_file' not in self.site.config['IPYNB_CONFIG'].get('Exporter', {}):
+                if ipynb.NBCONVERT_VERSION_MAJOR >= 6:
+                    c['Exporter']['template_file'] = 'classic/base.html.j2'
+                else:
+                    c['Exporter']['template_file'] = 'basic.tpl'  # not a typo
+            settings = json.dumps([self.cache_version, nbconvert.__version__, pygments.__version__, c],
+                                  sort_keys=True, default=repr)
+            self._exporter_cache = HTMLExporter(config=c), settings
+        return self._exporter_cache
+
+    def _cache_path(self, settings, key):
+        """Return the render cache file for a key made of notebook parts."""
+        digest = hashlib.sha256(settings.encode('utf-8'))
+        digest.update(json.dumps(key, sort_keys=True).encode('utf-8'))
+        digest = digest.hexdigest()
+        return os.path.join(self.site.config['CACHE_FOLDER'], 'ipynb', digest[:2], digest + '.html')
+
+    def _cached_export(self, nb, key):
+        """Export a notebook as HTML, or return the cached HTML for key."""
+        exporter, settings = self._exporter()
+        cache_path = self._cache_path(settings, key)
+        if os.path.exists(cache_path):
+            with codecs.open(cache_path, 'r', 'utf8') as fd:
+                return fd.read()
+        body, _ = exporter.from_notebook_node(nb)
+        write_file(cache_path, body.encode('utf8'))
+        return body
+
+    @staticmethod
+    def _with_cells(nb, cells):
+        """Return a shallow copy of a notebook with other cells."""
+        nb = copy.copy(nb)
+        nb['cells'] = cells
+        return nb
+
+    def _compile_string(self, nb_json):
+        """Export notebooks as HTML strings, cell by cell, through the render cache.
+
+        Every cell is rendered on its own and cached, keyed by the normalized
+        cell, the notebook metadata, the exporter configuration and the
+        nbconvert and Pygments versions. Editing a cell only runs nbconvert
+        for that cell, and template or config changes that only re-render
+        the page do not run it at all.
+
+        The HTML of a notebook is its cells followed by what the template
+        writes around them, which is the render of the notebook without
+        cells. Templates that do not render cells independently are detected
+        and get the whole notebook rendered (and cached) at once.
+
+        Image outputs are moved to files before rendering, see
+        externalize_outputs; the notebook_outputs task copies them to the
+        output folder.
+        """
+        self._req_missing_ipynb()
+        nb_json = normalize_notebook(nb_json)
+        externalize_outputs(
+            nb_json, os.path.join(self.site.config['CACHE_FOLDER'], 'ipynb_outputs'),
+            '/' + self.site.config.get('IPYNB_OUTPUTS_FOLDER', 'notebook_outputs'),
+            self.site.config.get('IPYNB_EXTERNAL_OUTPUT_MIN_SIZE', 2048))
+        header = {k: v for k, v in nb_json.items() if k != 'cells'}
+        frame = self._cached_export(self._with_cells(nb_json, []), ['frame', header])
+        fragments = []
+        for cell in nb_json['cells']:
+            body = self._cached_export(self._with_cells(nb_json, [cell]), ['cell', header, cell])
+            if not body.endswith(frame):
+                return self._cached_export(nb_json, ['notebook', nb_json])
+            fragments.append(body[:len(body) - len(frame)])
+        return ''.join(fragments) + frame
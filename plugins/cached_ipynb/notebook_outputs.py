@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+
+# Copyright © 2022 Quansight Labs and others.
+
+# Permission is hereby granted, free of charge, to any
+# person obtaining a copy of this software and associated
+# documentation files (the "Software"), to deal in the
+# Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the
+# Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice
+# shall be included in all copies or substantial portions of
+# the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY
+# KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+# WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR
+# PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS
+# OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+# OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+# OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""Copy the image outputs of notebook posts to the output folder."""
+
+import codecs
+import os
+import re
+
+from nikola.plugin_categories import Task
+from nikola import utils
+
+
+class NotebookOutputs(Task):
+    """Copy the image outputs used by notebook posts to the output folder.
+
+    The ipynb compiler writes image outputs to a store in the cache folder,
+    named after their content; this copies those referenced by the compiled
+    posts to ``OUTPUT_FOLDER/IPYNB_OUTPUTS_FOLDER``.
+    """
+
+    name = "notebook_outputs"
+
+    def _referenced(self, path, kw):
+        """Return the names of the outputs a compiled post uses."""
+        if not os.path.exists(path):
+            return set()
+        with codecs.open(path, 'r', 'utf8') as fd:
+            return set(kw['url_re'].findall(fd.read()))
+
+    def copy_outputs(self, path, previous, compiled, kw):
+        """Copy the outputs of a compiled post, and remove those it no longer uses.
+
+        Outputs are named after their content: the ones already in the
+        output folder are up to date. Removed outputs are kept when another
+        post still uses them.
+        """
+        names = self._referenced(path, kw)
+        for name in sorted(names):
+            dest = os.path.join(kw['output_folder'], name)
+            if os.path.exists(dest):
+                continue
+            src = os.path.join(kw['store'], name)
+            if not os.path.exists(src):
+                # Compiled again by the next build, which writes the store anew
+                os.unlink(path)
+                self.logger.error("{0} is missing from {1}, run the build again to compile {2} again".format(
+                    name, kw['store'], path))
+                return False
+            utils.makedirs(kw['output_folder'])
+            utils.copy_file(src, dest)
+        unused = previous - names
+        if unused:
+            for other in compiled:
+                if other != path:
+                    unused -= self._referenced(other, kw)
+        for name in unused:
+            for suffix in ('', '.gz', '.br'):
+                dest = os.path.join(kw['output_folder'], name + suffix)
+                if os.path.exists(dest):
+                    os.unlink(dest)
+
+    def gen_tasks(self):
+        self.site.scan_posts()
+        outputs_folder = self.site.config.get('IPYNB_OUTPUTS_FOLDER', 'notebook_outputs')
+        kw = {
+            'store': os.path.join(self.site.config['CACHE_FOLDER'], 'ipynb_outputs'),
+            'output_folder': os.path.join(self.site.config['OUTPUT_FOLDER'], outputs_folder),
+            'translations': self.site.config['TRANSLATIONS'],
+            'url_re': re.compile(r'/{0}/([0-9a-f]+\.\w+)"'.format(re.escape(outputs_folder))),
+        }
+        compiled = []
+        for post in self.site.timeline:
+            if post.compiler.name != 'ipynb':
+                continue
+            for lang in kw['translations']:
+                if post.is_translation_available(lang):
+                    compiled.append(post.translated_base_path(lang))
+
+        yield self.group_task()
+        # Outputs used by several posts are the target of the first one only:
+        # doit does not allow tasks with common targets. On a first build,
+        # posts are compiled after this runs, and outputs only become targets
+        # on the next one.
+        owned = set()
+        for path in compiled:
+            previous = self._referenced(path, kw)
+            targets = sorted(previous - owned)
+            owned.update(targets)
+            yield {
+                'basename': self.name,
+                'name': path,
+                'file_dep': [path],
+                'targets': [os.path.join(kw['output_folder'], name) for name in targets],
+                'actions': [(self.copy_outputs, (path, previous, compiled, kw))],
+                'clean': True,
+            }
@@ -29,12 +29,20 @@
 from __future__ import unicode_literals
 
 import codecs
+import hashlib
+import io
+import json
 import os
+import tempfile
 
 try:
     import commonmark
 except ImportError:
     commonmark = None  # NOQA
+try:
+    from importlib.metadata import version as package_version
+except ImportError:
+    package_version = None  # NOQA
 try:
     from collections import OrderedDict
 except ImportError:
@@ -45,17 +53,133 @@ from nikola.plugin_categories import PageCompiler
 from nikola.utils import makedirs, req_missing, write_metadata
 
 
+def render_markdown(data, parser, renderer):
+    """Render a document block by block.
+
+    Returns the shortcodes extracted from the document and an iterator over
+    the HTML of its top-level blocks, with placeholders for the shortcodes.
+    """
+    new_data, shortcodes = sc.extract_shortcodes(data)
+    document = parser.parse(new_data)
+
+    def blocks():
+        node = document.first_child
+        while node is not None:
+            yield renderer.render(node)
+            node = node.nxt
+
+    return shortcodes, blocks()
+
+
 class CompileCommonMark(PageCompiler):
     """Compile CommonMark into HTML."""
 
     name = "commonmark"
     demote_headers = True
+    # Bump when the format of the render cache changes
+    cache_version = 2
 
     def __init__(self, *args, **kwargs):
         super(CompileCommonMark, self).__init__(*args, **kwargs)
         if commonmark is not None:
             self.parser = commonmark.Parser()
             self.renderer = commonmark.HtmlRenderer()
+            self.commonmark_version = package_version('commonmark') if package_version else ''
+
+    def _cache_path(self, data):
+        """Return the render cache file for a document."""
+        key = hashlib.sha256()
+        key.update('{0}:{1}:'.format(self.cache_version, self.commonmark_version).encode('utf-8'))
+        key.update(data.encode('utf-8'))
+        digest = key.hexdigest()
+        return os.path.join(self.site.config['CACHE_FOLDER'], 'commonmark', digest[:2], digest + '.json')
+
+    def _load_cached(self, data):
+        """Return the cached shortcodes and blocks of a document, or None.
+
+        Cache files hold one JSON value per line: the shortcodes, then the
+        HTML of each block. Blocks are read lazily.
+        """
+        cache_path = self._cache_path(data)
+        if not os.path.exists(cache_path):
+            return None
+        fd = codecs.open(cache_path, "r", "utf8")
+        try:
+            shortcodes = json.loads(fd.readline())
+        except ValueError:
+            fd.close()
+            return None
+
+        def blocks():
+            with fd:
+                for line in fd:
+                    yield json.loads(line)
+
+        return shortcodes, blocks()
+
+    def _store_cached(self, data, shortcodes, blocks):
+        """Write blocks to the render cache while passing them through."""
+        cache_path = self._cache_path(data)
+        makedirs(os.path.dirname(cache_path))
+        # A temporary file of its own: parallel builds may render the same document
+        handle, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(cache_path))
+        try:
+            with io.open(handle, "w", encoding="utf8") as fd:
+                fd.write(json.dumps(shortcodes) + '\n')
+                for block in blocks:
+                    fd.write(json.dumps(block) + '\n')
+                    yield block
+            # Only complete renders make it into the cache
+            os.replace(tmp_path, cache_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+
+    def _render(self, data):
+        """Render a document, returning its shortcodes and an iterator over its blocks.
+
+        Results are kept in an on-disk cache keyed by the document content and
+        the commonmark version, so rebuilding an unchanged post (e.g. after a
+        config change) skips the Markdown parse. Shortcodes are applied by the
+        caller on every compile, so their output never comes from the cache.
+        """
+        cached = self._load_cached(data)
+        if cached is not None:
+            return cached
+        shortcodes, blocks = render_markdown(data, self.parser, self.renderer)
+        return shortcodes, self._store_cached(data, shortcodes, blocks)
+
+    def _apply_shortcodes(self, blocks, shortcodes, deps, source_path, post, lang):
+        """Apply shortcodes block by block, adding their dependencies to deps.
+
+        Each shortcode placeholder lives in a single block, so no block needs
+        more than its own shortcodes.
+        """
+        for block in blocks:
+            block_shortcodes = {k: v for k, v in shortcodes.items() if k in block}
+            if block_shortcodes:
+                block, block_deps = self.site.apply_shortcodes_uuid(
+                    block, block_shortcodes, filename=source_path, lang=lang, extra_context={'post': post})
+                deps.extend(block_deps)
+            yield block
+
+    def _write(self, dest, blocks, shortcodes, source, post, lang):
+        """Stream the final HTML into dest, returning the shortcode dependencies."""
+        deps = []
+        makedirs(os.path.dirname(dest))
+        with codecs.open(dest, "w+", "utf8") as out_file:
+            for block in self._apply_shortcodes(blocks, shortcodes, deps, source, post, lang):
+                out_file.write(block)
+        return deps
+
+    def _save_deps(self, source, dest, post, shortcode_deps):
+        if post is None:
+            if shortcode_deps:
+                self.logger.error(
+                    "Cannot save dependencies for post {0} (post unknown)",
+                    source)
+        else:
+            post._depfile[dest] += shortcode_deps
 
     def compile_string(self, data, source_path=None, is_two_file=True, post=None, lang=None):
         """Compile the source file into HTML strings (with shortcode support).
@@ -66,28 +190,26 @@ class CompileCommonMark(PageCompiler):
             req_missing(['commonmark'], 'build this site (compile with CommonMark)')
         if not is_two_file:
             _, data = self.split_metadata(data, post, lang)
-        new_data, shortcodes = sc.extract_shortcodes(data)
-        output = self.renderer.render(self.parser.parse(new_data))
-        output, shortcode_deps = self.site.apply_shortcodes_uuid(output, shortcodes, filename=source_path, extra_context={'post': post})
+        shortcodes, blocks = self._render(data)
+        shortcode_deps = []
+        output = ''.join(self._apply_shortcodes(blocks, shortcodes, shortcode_deps, source_path, post, lang))
         return output, shortcode_deps
 
     def compile(self, source, dest, is_two_file=True, post=None, lang=None):
-        """Compile the source file into HTML and save as dest."""
+        """Compile the source file into HTML and save as dest.
+
+        The HTML is written block by block, so the whole rendered document is
+        never held in memory as a single string.
+        """
         if commonmark is None:
             req_missing(['commonmark'], 'build this site (compile with CommonMark)')
-        makedirs(os.path.dirname(dest))
-        with codecs.open(dest, "w+", "utf8") as out_file:
-            with codecs.open(source, "r", "utf8") as in_file:
-                data = in_file.read()
-            output, shortcode_deps = self.compile_string(data, source, is_two_file, post, lang)
-            out_file.write(output)
-        if post is None:
-            if shortcode_deps:
-                self.logger.error(
-                    "Cannot save dependencies for post {0} (post unknown)",
-                    source)
-        else:
-            post._depfile[dest] += shortcode_deps
+        with codecs.open(source, "r", "utf8") as in_file:
+            data = in_file.read()
+        if not is_two_file:
+            _, data = self.split_metadata(data, post, lang)
+        shortcodes, blocks = self._render(data)
+        shortcode_deps = self._write(dest, blocks, shortcodes, source, post, lang)
+        self._save_deps(source, dest, post, shortcode_deps)
 
     def create_post(self, path, content=None, onefile=False, is_page=False, **kw):
         """Create post file with optional metadata."""
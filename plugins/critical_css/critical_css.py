@@ -0,0 +1,372 @@
+# -*- coding: utf-8 -*-
+
+# Copyright © 2022 Quansight Labs and others.
+
+# Permission is hereby granted, free of charge, to any
+# person obtaining a copy of this software and associated
+# documentation files (the "Software"), to deal in the
+# Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the
+# Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice
+# shall be included in all copies or substantial portions of
+# the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY
+# KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+# WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR
+# PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS
+# OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+# OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+# OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""Inline the above the fold CSS of each page and defer stylesheets."""
+
+import codecs
+import fnmatch
+import hashlib
+import json
+import functools
+import os
+import posixpath
+import re
+from urllib.parse import urlsplit
+
+from nikola import utils
+from nikola.packages.pygments_better_html import BetterHtmlFormatter
+from nikola.plugin_categories import Task
+from nikola.plugins.task.bundles import get_theme_bundles
+
+COMMENT_RE = re.compile(r'/\*.*?\*/', re.DOTALL)
+CSS_TOKEN_RE = re.compile(r'''"(?:\\.|[^"\\])*"|'(?:\\.|[^'\\])*'|[{};]''')
+CSS_URL_RE = re.compile(r'''url\(\s*(["']?)([^"')]+)\1\s*\)''')
+GROUP_RULES = ('@media', '@supports')
+PSEUDO_RE = re.compile(r':not\([^)]*\)|::?[\w-]+(?:\([^)]*\))?')
+ATTRIBUTE_SELECTOR_RE = re.compile(r'\[\s*([\w-]+)[^\]]*\]')
+NAME_RE = re.compile(r'([.#]?)(-?[_a-zA-Z](?:[\w-]|\\.)*)')
+FONT_FAMILY_RE = re.compile(r'font-family\s*:\s*([^;]+)')
+
+# <link> tags, and <noscript> blocks whose links must stay as they are
+LINK_RE = re.compile(r'<noscript>.*?</noscript>|<link\b[^>]*>', re.IGNORECASE | re.DOTALL)
+STYLESHEET_RE = re.compile(r'''\brel=(["']?)stylesheet\1''', re.IGNORECASE)
+PRELOAD_RE = re.compile(r'''\brel="preload" as="style"''')
+HREF_RE = re.compile(r'''\bhref=(["'])(.*?)\1''', re.IGNORECASE)
+STYLE_RE = re.compile(r'<style data-critical-css="([0-9a-f]*)">.*?</style>', re.DOTALL)
+TAG_RE = re.compile(r'''<([a-zA-Z][\w-]*)((?:[^>"']|"[^"]*"|'[^']*')*)>''')
+ATTR_RE = re.compile(r'''([\w:-]+)(?:\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s>]+)))?''')
+# Copies written by the fingerprint_assets plugin
+HASHED_RE = re.compile(r'\.[0-9a-f]{12}(?=\.[^./]+$)')
+DEFERRED = '''rel="preload" as="style" onload="this.onload=null;this.rel='stylesheet'"'''
+MARKER = '\0critical-css\0'
+
+
+def parse_css(text):
+    """Parse a stylesheet into a list of (prelude, body) pairs.
+
+    The body of @media and @supports rules is itself a list of pairs, the
+    body of other rules is their declarations. Statements like @import are
+    dropped.
+    """
+    rules, _ = _parse_block(COMMENT_RE.sub('', text), 0)
+    return rules
+
+
+def _parse_block(text, pos):
+    rules = []
+    start = pos
+    while True:
+        match = CSS_TOKEN_RE.search(text, pos)
+        if match is None:
+            return rules, len(text)
+        token = match.group()
+        pos = match.end()
+        if token == ';':
+            start = pos
+        elif token == '}':
+            return rules, pos
+        elif token == '{':
+            prelude = text[start:match.start()].strip()
+            if prelude.startswith(GROUP_RULES):
+                body, pos = _parse_block(text, pos)
+            else:
+                body_start, depth = pos, 1
+                while depth:
+                    match = CSS_TOKEN_RE.search(text, pos)
+                    if match is None:
+                        pos = len(text) + 1
+                        break
+                    pos = match.end()
+                    depth += {'{': 1, '}': -1}.get(match.group(), 0)
+                body = text[body_start:pos - 1].strip()
+            rules.append((prelude, body))
+            start = pos
+
+
+@functools.lru_cache(maxsize=None)
+def selector_names(selector):
+    """Return the tags, .classes, #ids and [attributes an element must have to match."""
+    selector = PSEUDO_RE.sub('', selector)
+    names = set('[' + name.lower() for name in ATTRIBUTE_SELECTOR_RE.findall(selector))
+    for prefix, name in NAME_RE.findall(ATTRIBUTE_SELECTOR_RE.sub(' ', selector)):
+        name = re.sub(r'\\(.)', r'\1', name)
+        names.add(prefix + name if prefix else name.lower())
+    return frozenset(names)
+
+
+def fold_names(html, elements):
+    """Return the names of the first elements of the body, as in selector_names."""
+    names = {'html', 'body'}
+    start = max(html.find('<body'), 0)
+    for count, match in enumerate(TAG_RE.finditer(html, start)):
+        if count >= elements:
+            break
+        names.add(match.group(1).lower())
+        for attr in ATTR_RE.finditer(match.group(2)):
+            name = attr.group(1).lower()
+            value = attr.group(2) or attr.group(3) or attr.group(4) or ''
+            names.add('[' + name)
+            if name == 'class':
+                names.update('.' + cls for cls in value.split())
+            elif name == 'id':
+                names.add('#' + value)
+    return names
+
+
+def critical_css(rules, names):
+    """Return the CSS of the rules with a selector matching the given names.
+
+    This is conservative: a selector is kept if all the names it uses are
+    present, wherever they are. @font-face rules are kept for the fonts the
+    kept rules use, other at-rules are dropped.
+    """
+    fonts = []
+    css = _critical(rules, names, fonts)
+    used = set(family.strip().strip('"\'').lower()
+               for families in FONT_FAMILY_RE.findall(css) for family in families.split(','))
+    for body in fonts:
+        family = FONT_FAMILY_RE.search(body)
+        if family and family.group(1).strip().strip('"\'').lower() in used:
+            css = '@font-face{{{0}}}'.format(body) + css
+    return css
+
+
+def fitting_critical_css(html, sheets, elements, max_size):
+    """Return the critical CSS of the most elements of a page that fits in max_size bytes, or None.
+
+    sheets are the parsed rules of the stylesheets of the page. Starting from
+    the first ``elements`` elements of the body, the fold is cut down until
+    its CSS fits.
+    """
+    def css_for(count):
+        names = fold_names(html, count)
+        return ''.join(critical_css(rules, names) for rules in sheets)
+
+    css = css_for(elements)
+    if len(css.encode('utf8')) <= max_size:
+        return css
+    best, low, high = None, 0, elements - 1
+    while low <= high:
+        middle = (low + high) // 2
+        candidate = css_for(middle)
+        if len(candidate.encode('utf8')) <= max_size:
+            best, low = candidate, middle + 1
+        else:
+            high = middle - 1
+    return best
+
+
+def _critical(rules, names, fonts):
+    out = []
+    for prelude, body in rules:
+        if isinstance(body, list):
+            inner = _critical(body, names, fonts)
+            if inner:
+                out.append('{0}{{{1}}}'.format(prelude, inner))
+        elif prelude.startswith('@font-face'):
+            fonts.append(body)
+        elif not prelude.startswith('@'):
+            selectors = [selector.strip() for selector in re.split(r',(?![^(]*\))', prelude)
+                         if selector_names(selector) <= names]
+            if selectors:
+                out.append('{0}{{{1}}}'.format(','.join(selectors), body))
+    return ''.join(out)
+
+
+def defer_stylesheets(html):
+    """Load the stylesheets of a page without blocking rendering.
+
+    Each stylesheet becomes a preload turned into a stylesheet once loaded,
+    followed by the original link for browsers without JavaScript. MARKER is
+    inserted before the first one.
+    """
+    def defer(match):
+        tag = match.group()
+        if tag.startswith('<noscript') or not STYLESHEET_RE.search(tag) or HREF_RE.search(tag) is None:
+            return tag
+        prefix = MARKER if not deferred else ''
+        deferred.append(tag)
+        return '{0}{1}<noscript>{2}</noscript>'.format(prefix, STYLESHEET_RE.sub(DEFERRED, tag, count=1), tag)
+
+    deferred = []
+    return LINK_RE.sub(defer, html)
+
+
+def stylesheet_hrefs(html):
+    """Return the stylesheets of a page, deferred or not."""
+    hrefs = []
+    for match in LINK_RE.finditer(html):
+        tag = match.group()
+        if tag.startswith('<noscript') or not (STYLESHEET_RE.search(tag) or PRELOAD_RE.search(tag)):
+            continue
+        href = HREF_RE.search(tag)
+        if href:
+            hrefs.append(href.group(2))
+    return hrefs
+
+
+class CriticalCSS(Task):
+    """Inline the above the fold CSS of each page and defer stylesheets."""
+
+    name = "critical_css"
+
+    def set_site(self, site):
+        self._parsed = {}
+        site.register_filter('critical_css', self.inline_critical_css)
+        super().set_site(site)
+        site_url = urlsplit(site.config['BASE_URL'])
+        self.kw = {
+            'output_folder': site.config['OUTPUT_FOLDER'],
+            'fold_elements': site.config.get('CRITICAL_CSS_FOLD_ELEMENTS', 150),
+            'max_size': site.config.get('CRITICAL_CSS_MAX_SIZE', 14336),
+            'exclude': site.config.get('CRITICAL_CSS_EXCLUDE', []),
+            'files_folders': site.config['FILES_FOLDERS'],
+            'use_bundles': site.config['USE_BUNDLES'],
+            'code_color_scheme': site.config['CODE_COLOR_SCHEME'],
+            'site_netloc': site_url.netloc,
+            'base_path': site_url.path.rstrip('/') + '/',
+        }
+
+    def _site_path(self, href, rel_path):
+        """Return the output relative path of a local stylesheet, or None."""
+        kw = self.kw
+        if href.startswith(('http:', 'https:', '//')):
+            parts = urlsplit(href)
+            if parts.netloc != kw['site_netloc']:
+                return None
+            href = parts.path
+        href = urlsplit(href).path
+        if href.startswith('/'):
+            if not href.startswith(kw['base_path']):
+                return None
+            path = href[len(kw['base_path']):]
+        else:
+            path = posixpath.normpath(posixpath.join(posixpath.dirname(rel_path), href))
+        return HASHED_RE.sub('', path)
+
+    def _code_css(self):
+        """Return the code.css copy_assets generates when no theme provides one."""
+        formatter = BetterHtmlFormatter(style=self.kw['code_color_scheme'])
+        return ('/* code.css file generated by Nikola */\n' + formatter.get_style_defs(
+            ['pre.code', '.code .codetable', '.highlight pre'], ['.highlight', '.code']) + (
+            "\ntable.codetable, table.highlighttable { width: 100%;}\n"
+            ".codetable td.linenos, td.linenos { text-align: right; width: 3.5em; "
+            "padding-right: 0.5em; background: rgba(127, 127, 127, 0.2) }\n"
+            ".codetable td.code, td.code { padding-left: 0.5em; }\n"))
+
+    def _stylesheet_source(self, path):
+        """Return the text of a stylesheet of the output, read from its sources, or None.
+
+        Stylesheets are read from the theme and FILES_FOLDERS rather than the
+        output, which may not be written yet. Bundles are put together from
+        their parts, like create_bundles does.
+        """
+        bundles = self._bundles()
+        if path in bundles:
+            parts = [self._stylesheet_source(posixpath.join(posixpath.dirname(path), part)) for part in bundles[path]]
+            return ''.join(part + '\n' for part in parts if part is not None)
+        src = utils.get_asset_path(path, self.site.THEMES, self.kw['files_folders'], output_dir=None)
+        if src is None:
+            return self._code_css() if path == 'assets/css/code.css' else None
+        with codecs.open(src, 'r', 'utf-8-sig') as fd:
+            return fd.read()
+
+    def _bundles(self):
+        if not self.kw['use_bundles']:
+            return {}
+        return dict((name.replace(os.sep, '/'), parts) for name, parts in get_theme_bundles(self.site.THEMES).items())
+
+    def _stylesheet_rules(self, path):
+        """Return the parsed rules of a stylesheet of the output with site absolute URLs, or None."""
+        if path not in self._parsed:
+            text = self._stylesheet_source(path)
+            if text is None:
+                self._parsed[path] = None
+                return None
+
+            def rebase(match):
+                url = match.group(2).strip()
+                if url.startswith(('data:', 'http:', 'https:', '//', '/', '#')):
+                    return match.group()
+                target = posixpath.normpath(posixpath.join(posixpath.dirname(path), url))
+                return 'url({0}{1})'.format(self.kw['base_path'], target)
+
+            self._parsed[path] = parse_css(CSS_URL_RE.sub(rebase, text))
+        return self._parsed[path]
+
+    def inline_critical_css(self, filename):
+        """Inline the critical CSS of a page and defer its stylesheets.
+
+        This is registered as the ``critical_css`` filter. The critical CSS
+        comes from the stylesheets whose sources are found, but all
+        stylesheets are deferred, third-party ones included. Pages whose
+        critical CSS does not fit in CRITICAL_CSS_MAX_SIZE are left as they are.
+        """
+        kw = self.kw
+        rel_path = os.path.relpath(filename, kw['output_folder']).replace(os.sep, '/')
+        if any(fnmatch.fnmatch(rel_path, pattern) for pattern in kw['exclude']):
+            return
+        with codecs.open(filename, 'r', 'utf8') as fd:
+            html = fd.read()
+        if STYLE_RE.search(html):
+            return
+        hrefs = stylesheet_hrefs(html)
+        if not hrefs:
+            return
+        sheets = []
+        for href in hrefs:
+            path = self._site_path(href, rel_path)
+            rules = self._stylesheet_rules(path) if path is not None else None
+            if rules is not None:
+                sheets.append(rules)
+        css = fitting_critical_css(html, sheets, kw['fold_elements'], kw['max_size'])
+        if css is None:
+            return
+        digest = hashlib.sha1(css.encode('utf8')).hexdigest()[:12]
+        style = '<style data-critical-css="{0}">{1}</style>'.format(digest, css)
+        with codecs.open(filename, 'w', 'utf8') as fd:
+            fd.write(defer_stylesheets(html).replace(MARKER, style, 1))
+
+    def _sources_digest(self):
+        """Return a digest of the stylesheets pages may use, and of the settings."""
+        digest = hashlib.sha1(json.dumps(
+            [self.kw, self.site.THEMES, self._bundles()], sort_keys=True, default=str).encode('utf8'))
+        folders = [os.path.join(utils.get_theme_path(theme), 'assets') for theme in self.site.THEMES]
+        for folder in folders + sorted(self.kw['files_folders']):
+            for root, dirs, fnames in os.walk(folder):
+                dirs.sort()
+                for fname in sorted(fnames):
+                    if fname.endswith('.css'):
+                        digest.update(os.path.join(root, fname).encode('utf8'))
+                        with open(os.path.join(root, fname), 'rb') as fd:
+                            digest.update(fd.read())
+        return digest.hexdigest()
+
+    def gen_tasks(self):
+        # Pages depend on GLOBAL_CONTEXT: they are rendered again, with the
+        # new critical CSS, when a stylesheet or a setting changes
+        self.site.GLOBAL_CONTEXT['critical_css'] = self._sources_digest()
+        yield self.group_task()
@@ -0,0 +1,357 @@
+# -*- coding: utf-8 -*-
+
+# Copyright © 2022 Quansight Labs and others.
+
+# Permission is hereby granted, free of charge, to any
+# person obtaining a copy of this software and associated
+# documentation files (the "Software"), to deal in the
+# Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the
+# Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice
+# shall be included in all copies or substantial portions of
+# the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY
+# KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+# WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR
+# PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS
+# OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+# OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+# OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""Write content hashed copies of static assets and point the HTML at them."""
+
+import codecs
+import fnmatch
+import hashlib
+import json
+import os
+import posixpath
+import re
+import shutil
+from urllib.parse import unquote, urlsplit
+
+from nikola.plugin_categories import LateTask
+from nikola.plugins.task.bundles import get_theme_bundles
+from nikola.utils import config_changed, makedirs
+
+# Copies written by this plugin, like custom.0123456789ab.css
+HASHED_RE = re.compile(r'\.[0-9a-f]{12}(\.[^./]+)$')
+# Start tags, and the attributes pointing to assets in them
+TAG_RE = re.compile(r'<[a-zA-Z][^<>]*>')
+URL_ATTR_RE = re.compile(r'''(\s(?:href|src|srcset)\s*=\s*)("[^"]*"|'[^']*'|[^\s"'>]+)''', re.IGNORECASE)
+# Variants written by the responsive_images plugin, like foo.png.480w.webp
+VARIANT_RE = re.compile(r'^(.*)\.\d+w\.(?:webp|avif)$')
+# Settings of the tasks resizing images: copies are renamed when they change.
+# Other settings must be left out, the task would not run again to write the
+# renamed copy.
+RESIZE_SETTINGS = {
+    'image': ['MAX_IMAGE_SIZE', 'IMAGE_THUMBNAIL_SIZE', 'IMAGE_THUMBNAIL_FORMAT', 'PRESERVE_EXIF_DATA',
+              'EXIF_WHITELIST', 'PRESERVE_ICC_PROFILES'],
+    'gallery': ['MAX_IMAGE_SIZE', 'THUMBNAIL_SIZE', 'PRESERVE_EXIF_DATA', 'EXIF_WHITELIST', 'PRESERVE_ICC_PROFILES'],
+    'variant': ['MAX_IMAGE_SIZE', 'RESPONSIVE_IMAGE_WIDTHS', 'RESPONSIVE_IMAGE_FORMATS', 'RESPONSIVE_IMAGE_QUALITY'],
+}
+
+
+def hashed_name(path, digest):
+    """Return the name, or URL, of the hashed copy of a file."""
+    base, ext = posixpath.splitext(path)
+    return '{0}.{1}{2}'.format(base, digest[:12], ext)
+
+
+class FingerprintAssets(LateTask):
+    """Write content hashed copies of static assets and point the HTML at them."""
+
+    name = "fingerprint_assets"
+
+    def set_site(self, site):
+        self._sources = None
+        self._digests = {}
+        site.register_filter('fingerprint_assets', self.fingerprint)
+        super().set_site(site)
+        site_url = urlsplit(site.config['BASE_URL'])
+        self.kw = {
+            'output_folder': site.config['OUTPUT_FOLDER'],
+            'cache_folder': site.config['CACHE_FOLDER'],
+            'folders': site.config.get('FINGERPRINT_FOLDERS', ['assets', 'images', 'galleries']),
+            'extensions': [ext.lower() for ext in site.config.get(
+                'FINGERPRINT_EXTENSIONS',
+                ['.css', '.js', '.json', '.png', '.jpg', '.jpeg', '.gif', '.svg', '.webp', '.avif'])],
+            'source_folders': site.config.get('FINGERPRINT_SOURCE_FOLDERS', {}),
+            'immutable': site.config.get(
+                'FINGERPRINT_IMMUTABLE', ['assets/js/search/docs-*', 'assets/js/search/terms-*', 'notebook_outputs/*']),
+            'max_age': site.config.get('FINGERPRINT_MAX_AGE', 31536000),
+            'site_netloc': site_url.netloc,
+            'base_path': site_url.path.rstrip('/') + '/',
+            'thumbnail_re': re.compile('^{0}$'.format(re.escape(site.config['IMAGE_THUMBNAIL_FORMAT']).replace(
+                re.escape('{name}'), '(?P<name>.*)').replace(re.escape('{ext}'), r'(?P<ext>\.[^./]+)'))),
+            'settings': dict((kind, json.dumps([site.config.get(key) for key in keys], sort_keys=True))
+                             for kind, keys in RESIZE_SETTINGS.items()),
+        }
+        self.url_re = self._url_re(self.kw['extensions'])
+
+    def _url_re(self, extensions):
+        """Match URLs of files with the given extensions in an attribute value.
+
+        This finds whole values and ``srcset`` candidates alike. Query strings
+        and fragments are left out.
+        """
+        exts = '|'.join(re.escape(ext.lstrip('.')) for ext in sorted(extensions))
+        return re.compile(
+            r'''(?<![\w/.:%~+-])((?:https?:)?[\w/.%~+-]*\.(?:{0}))(?=[?#"'\s,]|$)'''.format(exts),
+            re.IGNORECASE)
+
+    def _source_files(self):
+        """Yield (output relative path, source path, kind) of the assets copied to the output.
+
+        Theme assets, FILES_FOLDERS and FINGERPRINT_SOURCE_FOLDERS are copied
+        as they are, images and galleries are resized.
+        """
+        kw = self.kw
+        folders = []
+        for src_dir, dst_dir in list(self.site.config['FILES_FOLDERS'].items()) + list(kw['source_folders'].items()):
+            folders.append((src_dir, dst_dir, ''))
+        for theme in reversed(self.site.THEMES):
+            # Like utils.get_asset_path, themes win over FILES_FOLDERS and the first theme wins
+            folders.append((os.path.join(theme, 'assets'), 'assets', ''))
+        for src_dir, dst_dir in self.site.config['IMAGE_FOLDERS'].items():
+            folders.append((src_dir, dst_dir, 'image'))
+        for src_dir, dst_dir in self.site.config['GALLERY_FOLDERS'].items():
+            folders.append((src_dir, dst_dir, 'gallery'))
+        for src_dir, dst_dir, kind in folders:
+            for root, _, fnames in os.walk(src_dir):
+                for fname in fnames:
+                    if os.path.splitext(fname)[1].lower() not in kw['extensions']:
+                        continue
+                    src = os.path.join(root, fname)
+                    rel_path = posixpath.normpath(posixpath.join(
+                        dst_dir, os.path.relpath(src, src_dir).replace(os.sep, '/')))
+                    if any(rel_path.startswith(folder.strip('/') + '/') for folder in kw['folders']):
+                        yield rel_path, src, kind
+
+    def _asset_sources(self):
+        """Return {output relative path: [digest of the source, kind]} of the assets that have a source.
+
+        Sources with the same size and mtime as in the previous build are not
+        hashed again. Bundles and code.css, generated from sources, get a
+        digest of what they are made of. Other files generated during the
+        build have no source and keep their names.
+        """
+        if self._sources is not None:
+            return self._sources
+        state_path = os.path.join(self.kw['cache_folder'], 'fingerprint_assets.json')
+        old_files = {}
+        if os.path.exists(state_path):
+            with codecs.open(state_path, 'r', 'utf8') as fd:
+                old_files = json.load(fd).get('sources', {})
+        files = {}
+        sources = {}
+        for rel_path, src, kind in self._source_files():
+            stat = os.stat(src)
+            old = old_files.get(src)
+            if old is not None and old[:2] == [stat.st_size, stat.st_mtime]:
+                digest = old[2]
+            else:
+                with open(src, 'rb') as fd:
+                    digest = hashlib.sha1(fd.read()).hexdigest()
+            files[src] = [stat.st_size, stat.st_mtime, digest]
+            sources[rel_path] = [digest, kind]
+        makedirs(self.kw['cache_folder'])
+        with codecs.open(state_path, 'wb+', 'utf8') as fd:
+            json.dump({'sources': files}, fd, sort_keys=True)
+
+        if 'assets/css/code.css' not in sources:
+            scheme = json.dumps(self.site.config['CODE_COLOR_SCHEME'])
+            sources['assets/css/code.css'] = [hashlib.sha1(scheme.encode('utf8')).hexdigest(), '']
+        if self.site.config['USE_BUNDLES']:
+            for name, inputs in get_theme_bundles(self.site.THEMES).items():
+                name = name.replace(os.sep, '/')
+                inputs = [posixpath.normpath(posixpath.join(posixpath.dirname(name), path)) for path in inputs]
+                parts = json.dumps([sources.get(path) for path in inputs])
+                sources[name] = [hashlib.sha1(parts.encode('utf8')).hexdigest(), '']
+        self._sources = sources
+        return sources
+
+    def asset_digest(self, rel_path):
+        """Return the digest naming the hashed copy of an asset of the output, or None."""
+        if rel_path not in self._digests:
+            kw = self.kw
+            sources = self._asset_sources()
+            name = posixpath.basename(rel_path)
+            source = kind = None
+            if (os.path.splitext(name)[1].lower() in kw['extensions'] and not HASHED_RE.search(name)
+                    and not any(fnmatch.fnmatch(rel_path, pattern) for pattern in kw['immutable'])):
+                source = sources.get(rel_path)
+                thumbnail = kw['thumbnail_re'].match(rel_path)
+                variant = VARIANT_RE.match(rel_path)
+                if source is not None:
+                    digest, kind = source
+                elif thumbnail:
+                    # Thumbnails are written by the task resizing their image
+                    source = sources.get(thumbnail.group('name') + thumbnail.group('ext'))
+                    digest, kind = source or (None, None)
+                elif variant and sources.get(variant.group(1), [None, None])[1] == 'image':
+                    source = sources[variant.group(1)]
+                    digest, kind = source[0], 'variant'
+            if source is not None and kind:
+                digest = hashlib.sha1((digest + kw['settings'][kind]).encode('utf8')).hexdigest()
+            self._digests[rel_path] = None if source is None else digest
+        return self._digests[rel_path]
+
+    def _rewrite_page(self, path, rel_path):
+        """Point the references of an HTML file to hashed copies."""
+        kw = self.kw
+        page_dir = posixpath.dirname(rel_path)
+
+        def replace(match):
+            url = match.group(1)
+            if url.startswith(('http:', 'https:', '//')):
+                parts = urlsplit(url)
+                if parts.netloc != kw['site_netloc']:
+                    return url
+                target = parts.path
+            else:
+                target = url
+            target = unquote(target)
+            if target.startswith('/'):
+                if not target.startswith(kw['base_path']):
+                    return url
+                target = target[len(kw['base_path']):]
+            else:
+                target = posixpath.normpath(posixpath.join(page_dir, target))
+            digest = self.asset_digest(target)
+            if digest is None:
+                return url
+            return hashed_name(url, digest)
+
+        def replace_attrs(match):
+            return URL_ATTR_RE.sub(lambda attr: attr.group(1) + self.url_re.sub(replace, attr.group(2)), match.group(0))
+
+        # Only href, src and srcset attributes: text, code samples and
+        # scripts mentioning an asset are left alone
+        with codecs.open(path, 'r', 'utf8') as fd:
+            data = fd.read()
+        new_data = TAG_RE.sub(replace_attrs, data)
+        if new_data != data:
+            with codecs.open(path, 'w', 'utf8') as fd:
+                fd.write(new_data)
+
+    def _write_copy(self, path, rel_path):
+        """Write the hashed copy of an asset, and remove the copies of its previous versions."""
+        digest = self.asset_digest(rel_path)
+        if digest is None:
+            return
+        # A copy, not a link: Nikola overwrites assets in place. Compressed
+        # siblings written by the precompress filter are copied along.
+        for suffix in ('', '.gz', '.br'):
+            if suffix == '' or os.path.exists(path + suffix):
+                shutil.copy2(path + suffix, hashed_name(path, digest) + suffix)
+        base, ext = os.path.splitext(os.path.basename(path))
+        copy_re = re.compile(r'{0}\.([0-9a-f]{{12}}){1}(\.gz|\.br)?$'.format(re.escape(base), re.escape(ext)))
+        folder = os.path.dirname(path)
+        for fname in os.listdir(folder):
+            match = copy_re.match(fname)
+            if match and match.group(1) != digest[:12]:
+                os.unlink(os.path.join(folder, fname))
+
+    def fingerprint(self, filename):
+        """Point the references of HTML files to hashed copies, and write the copies of assets.
+
+        This is registered as the ``fingerprint_assets`` filter. It runs in
+        the tasks writing the files, so that doit keeps track of the result.
+        """
+        rel_path = os.path.relpath(filename, self.kw['output_folder']).replace(os.sep, '/')
+        if filename.endswith('.html'):
+            self._rewrite_page(filename, rel_path)
+        else:
+            self._write_copy(filename, rel_path)
+
+    def _hashed_copies(self):
+        """Return {path of a hashed copy: (path, output relative path) of its asset} for the assets in the output.
+
+        The assets are the sources, the thumbnails of images and galleries,
+        and the variants written by responsive_images next to images.
+        """
+        kw = self.kw
+        candidates = set()
+        image_folders = set()
+        for rel_path, (_, kind) in self._asset_sources().items():
+            candidates.add(rel_path)
+            if kind in ('image', 'gallery'):
+                name, ext = posixpath.splitext(rel_path)
+                candidates.add(self.site.config['IMAGE_THUMBNAIL_FORMAT'].format(name=name, ext=ext))
+            if kind == 'image':
+                image_folders.add(posixpath.dirname(rel_path))
+        for folder in image_folders:
+            path = os.path.join(kw['output_folder'], folder)
+            if os.path.isdir(path):
+                candidates.update(posixpath.join(folder, fname) for fname in os.listdir(path) if VARIANT_RE.match(fname))
+        copies = {}
+        for rel_path in candidates:
+            digest = self.asset_digest(rel_path)
+            path = os.path.join(kw['output_folder'], *rel_path.split('/'))
+            if digest is not None and os.path.exists(path):
+                copies[hashed_name(path, digest)] = (path, rel_path)
+        return copies
+
+    def _write_headers(self):
+        """Write a Netlify _headers file marking the hashed copies and FINGERPRINT_IMMUTABLE immutable.
+
+        Missing copies are written again first. The file is only written when
+        it changed.
+        """
+        kw = self.kw
+        lines = ['# Generated by the fingerprint_assets plugin: these files are named after their content']
+        paths = list(kw['immutable'])
+        for copy, (path, rel_path) in self._hashed_copies().items():
+            if not os.path.exists(copy):
+                self._write_copy(path, rel_path)
+            paths.append(hashed_name(rel_path, self.asset_digest(rel_path)))
+        for rel_path in sorted(paths):
+            lines.append(kw['base_path'] + rel_path)
+            lines.append('  Cache-Control: public, max-age={0}, immutable'.format(kw['max_age']))
+        data = '\n'.join(lines) + '\n'
+        path = os.path.join(kw['output_folder'], '_headers')
+        if os.path.exists(path):
+            with codecs.open(path, 'r', 'utf8') as fd:
+                if fd.read() == data:
+                    return
+        with codecs.open(path, 'w', 'utf8') as fd:
+            fd.write(data)
+
+    def gen_tasks(self):
+        # Pages depend on GLOBAL_CONTEXT: they are rendered again, pointing to
+        # the new copies, when an asset changes
+        sources = json.dumps([self._asset_sources(), self.kw['settings']], sort_keys=True)
+        self.site.GLOBAL_CONTEXT['fingerprint_assets'] = hashlib.sha1(sources.encode('utf8')).hexdigest()
+
+        # Run after everything else that writes to the output folder
+        task_dep = ['render_site']
+        for plugin_info in self.site.plugin_manager.getPluginsOfCategory('LateTask'):
+            plugin = plugin_info.plugin_object
+            if plugin.is_default and plugin.name != self.name:
+                task_dep.append(plugin.name)
+
+        # The copies are written by the filter, in the tasks writing their
+        # assets: they are targets here so that missing ones are written
+        # again, and `nikola check --clean-files` keeps them. Only copies of
+        # assets already in the output are listed: on a first build, they
+        # become targets on the next one.
+        yield {
+            'basename': self.name,
+            'name': 'headers',
+            'targets': [os.path.join(self.kw['output_folder'], '_headers')] + sorted(self._hashed_copies()),
+            'actions': [(self._write_headers, [])],
+            'task_dep': task_dep,
+            'uptodate': [config_changed({
+                1: self.site.GLOBAL_CONTEXT['fingerprint_assets'],
+                2: self.kw['immutable'],
+                3: self.kw['max_age'],
+                4: self.kw['base_path'],
+            }, 'fingerprint_assets:headers')],
+        }
@@ -24,16 +24,37 @@
 # OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
 # SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
+import hashlib
 import json
 import os
 
 from docutils import nodes
 from docutils.parsers.rst import Directive, directives
-import lxml
 
 from nikola.plugin_categories import RestExtension
 from nikola.utils import LocaleBorg
 
+# Written next to each gallery by the gallery_manifest plugin
+MANIFEST_NAME = 'photos.json'
+
+# manifest path -> (mtime, content hash, photo array)
+_manifest_cache = {}
+
+# (gallery name, template name, manifest hash, lang) -> rendered HTML
+_render_cache = {}
+
+
+def load_manifest(manifest_file):
+    """Return the content hash and photo array of a gallery manifest, memoized per process."""
+    mtime = os.stat(manifest_file).st_mtime
+    cached = _manifest_cache.get(manifest_file)
+    if cached is None or cached[0] != mtime:
+        with open(manifest_file, 'rb') as inf:
+            data = inf.read()
+        cached = (mtime, hashlib.sha1(data).hexdigest(), json.loads(data.decode('utf-8'))['photo_array'])
+        _manifest_cache[manifest_file] = cached
+    return cached[1:]
+
 
 class Plugin(RestExtension):
 
@@ -41,7 +62,7 @@ class Plugin(RestExtension):
 
     def set_site(self, site):
         self.site = site
-        self.inject_dependency('render_posts', 'render_galleries')
+        self.inject_dependency('render_posts', 'render_site_gallery_manifest')
         Gallery.site = site
         directives.register_directive('gallery', Gallery)
         return super(Plugin, self).set_site(site)
@@ -70,22 +91,23 @@ class Gallery(Directive):
             'thumbnail_size': self.site.config['THUMBNAIL_SIZE'],
         }
         gallery_index_file = os.path.join(kw['output_folder'], self.site.path('gallery', gallery_name))
-        gallery_index_path = self.site.path('gallery', gallery_name)
-        gallery_folder = os.path.dirname(gallery_index_path)
-        self.state.document.settings.record_dependencies.add(gallery_index_file)
-        with open(gallery_index_file, 'r') as inf:
-            data = inf.read()
-        dom = lxml.html.fromstring(data)
-        text = [e.text for e in dom.xpath('//script') if e.text and 'jsonContent = ' in e.text][0]
-        photo_array = json.loads(text.split(' = ', 1)[1].split(';', 1)[0])
-        for img in photo_array:
-            img['url'] = '/' + '/'.join([gallery_folder, img['url']])
-            img['url_thumb'] = '/' + '/'.join([gallery_folder, img['url_thumb']])
+        manifest_file = os.path.join(os.path.dirname(gallery_index_file), MANIFEST_NAME)
+        self.state.document.settings.record_dependencies.add(manifest_file)
+        manifest_hash, photo_array = load_manifest(manifest_file)
+        lang = LocaleBorg().current_lang
+        # Pages embedding the same gallery get the same HTML
+        key = (gallery_name, template_name, manifest_hash, lang)
+        if key not in _render_cache:
+            _render_cache[key] = self.render(template_name, photo_array, lang, kw)
+        return [nodes.raw('', _render_cache[key], format='html')]
+
+    def render(self, template_name, photo_array, lang, kw):
+        """Render the gallery template for a photo array."""
         photo_array_json = json.dumps(photo_array)
         context = {}
         context['description'] = ''
         context['title'] = ''
-        context['lang'] = LocaleBorg().current_lang
+        context['lang'] = lang
         context['crumbs'] = []
         context['folders'] = []
         context['photo_array'] = photo_array
@@ -93,9 +115,8 @@ class Gallery(Directive):
         context['permalink'] = '#'
         context.update(self.site.GLOBAL_CONTEXT)
         context.update(kw)
-        output = self.site.template_system.render_template(
+        return self.site.template_system.render_template(
             template_name,
             None,
             context
         )
-        return [nodes.raw('', output, format='html')]
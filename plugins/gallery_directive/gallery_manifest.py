@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+# Copyright © 2012-2013 Roberto Alsina and others.
+
+# Permission is hereby granted, free of charge, to any
+# person obtaining a copy of this software and associated
+# documentation files (the "Software"), to deal in the
+# Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the
+# Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice
+# shall be included in all copies or substantial portions of
+# the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY
+# KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+# WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR
+# PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS
+# OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+# OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+# OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import json
+import os
+import re
+
+import lxml.html
+
+from nikola.plugin_categories import TaskMultiplier
+from nikola.utils import apply_filters, makedirs
+
+# Written next to the index.html of every gallery
+MANIFEST_NAME = 'photos.json'
+# Copies written by the fingerprint_assets filter, like foo.0123456789ab.jpg
+HASHED_RE = re.compile(r'\.[0-9a-f]{12}(?=\.[^./]+$)')
+
+
+def write_manifest(index_file, manifest_file, gallery_folder):
+    """Extract the photo array of a rendered gallery index into a JSON manifest.
+
+    Image URLs are made absolute, so the manifest can be used from any page.
+    They point to the images themselves rather than to their fingerprinted
+    copies: the pages using the manifest are fingerprinted in turn.
+    """
+    with open(index_file, 'r') as inf:
+        data = inf.read()
+    dom = lxml.html.fromstring(data)
+    text = [e.text for e in dom.xpath('//script') if e.text and 'jsonContent = ' in e.text][0]
+    photo_array = json.loads(text.split(' = ', 1)[1].split(';', 1)[0])
+    for img in photo_array:
+        img['url'] = '/' + '/'.join([gallery_folder, HASHED_RE.sub('', img['url'])])
+        img['url_thumb'] = '/' + '/'.join([gallery_folder, HASHED_RE.sub('', img['url_thumb'])])
+    makedirs(os.path.dirname(manifest_file))
+    with open(manifest_file, 'w') as outf:
+        json.dump({'photo_array': photo_array}, outf, sort_keys=True)
+
+
+class GalleryManifest(TaskMultiplier):
+    """Add a task writing a manifest for each gallery index."""
+
+    name = "gallery_manifest"
+
+    def process(self, task, prefix):
+        # By now doit has folded the basename into the task name
+        if not (task.get('name') or '').startswith('render_galleries:'):
+            return []
+        output_folder = self.site.config['OUTPUT_FOLDER']
+        index_name = self.site.config['INDEX_FILE']
+        tasks = []
+        for target in task.get('targets', []):
+            if os.path.basename(target) != index_name or not target.startswith(output_folder):
+                continue
+            manifest_file = os.path.join(os.path.dirname(target), MANIFEST_NAME)
+            gallery_folder = os.path.dirname(os.path.relpath(target, output_folder)).replace(os.sep, '/')
+            tasks.append(apply_filters({
+                'basename': '{0}_{1}'.format(prefix, self.name),
+                'name': manifest_file,
+                'file_dep': [target],
+                'targets': [manifest_file],
+                'actions': [(write_manifest, (target, manifest_file, gallery_folder))],
+                'clean': True,
+            }, self.site.config['FILTERS']))
+        return tasks
@@ -26,8 +26,10 @@
 
 from __future__ import unicode_literals
 import codecs
+import hashlib
 import json
 import os
+import re
 
 from nikola.plugin_categories import LateTask
 from nikola.utils import apply_filters, config_changed, copy_tree, makedirs
@@ -46,6 +48,113 @@ from nikola.utils import apply_filters, config_changed, copy_tree, makedirs
 #         studio based in North London. We've been around for over a decade.", "tags": "",
 #         "loc": "http://www.tipue.com/about"}
 # ]};
+#
+# With LOCALSEARCH_INVERTED_INDEX = True we produce an inverted index instead,
+# which is queried by localsearch.js without scanning the text of every page:
+# {"docs": [["title", "url", "tags", "summary"], ...],
+#  "terms": {"term": [[doc_id, [position, ...]], ...], ...}}
+#
+# The index is split into shards under assets/js/search/: terms are grouped by
+# their first LOCALSEARCH_SHARD_PREFIX_LENGTH characters and docs in blocks of
+# LOCALSEARCH_DOCS_PER_SHARD. A manifest tells the client which file holds
+# what, so a query only downloads the shards it touches:
+# {"prefix_length": 2, "docs_per_shard": 100,
+#  "docs": ["docs-<hash>.json", ...], "terms": {"nu": "terms-<hash>.json", ...}}
+
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+# Keep in sync with tipuesearch_stop_words in tipuesearch_set.js (the words
+# with apostrophes never survive tokenization, so they are left out).
+STOP_WORDS = frozenset([
+    'a', 'about', 'above', 'after', 'again', 'against', 'all', 'am', 'an',
+    'and', 'any', 'are', 'as', 'at', 'be', 'because', 'been', 'before',
+    'being', 'below', 'between', 'both', 'but', 'by', 'cannot', 'could',
+    'did', 'do', 'does', 'doing', 'down', 'during', 'each', 'few', 'for',
+    'from', 'further', 'had', 'has', 'have', 'having', 'he', 'her', 'here',
+    'hers', 'herself', 'him', 'himself', 'his', 'how', 'i', 'if', 'in',
+    'into', 'is', 'it', 'its', 'itself', 'me', 'more', 'most', 'my',
+    'myself', 'no', 'nor', 'not', 'of', 'off', 'on', 'once', 'only', 'or',
+    'other', 'ought', 'our', 'ours', 'ourselves', 'out', 'over', 'own',
+    'same', 'she', 'should', 'so', 'some', 'such', 'than', 'that', 'the',
+    'their', 'theirs', 'them', 'themselves', 'then', 'there', 'these',
+    'they', 'this', 'those', 'through', 'to', 'too', 'under', 'until', 'up',
+    'very', 'was', 'we', 'were', 'what', 'when', 'where', 'which', 'while',
+    'who', 'whom', 'why', 'with', 'would', 'you', 'your', 'yours', 'yourself',
+    'yourselves',
+])
+
+SUMMARY_WORDS = 40
+
+
+def tokenize(text, offset=0):
+    """Split text into lowercase terms, skipping stop words.
+
+    Returns a list of ``(position, term)`` pairs. Stop words still count
+    towards positions, so that phrase queries line up with the document.
+    """
+    return [(offset + position, term)
+            for position, term in enumerate(TOKEN_RE.findall(text.lower()))
+            if term not in STOP_WORDS]
+
+
+def build_inverted_index(pages):
+    """Build an inverted index out of the page data used for Tipue."""
+    docs = []
+    postings = {}
+    for doc_id, page in enumerate(pages):
+        docs.append([page["title"], page["url"], page["tags"],
+                     " ".join(page["text"].split()[:SUMMARY_WORDS])])
+        offset = 0
+        # Leave a gap between fields so phrases do not match across them
+        for field in (page["title"], page["tags"].replace(",", " "), page["text"]):
+            tokens = tokenize(field, offset)
+            for position, term in tokens:
+                postings.setdefault(term, {}).setdefault(doc_id, []).append(position)
+            offset = (tokens[-1][0] if tokens else offset) + 2
+    terms = {}
+    for term, doc_positions in postings.items():
+        terms[term] = [[doc_id, positions] for doc_id, positions in sorted(doc_positions.items())]
+    return {"docs": docs, "terms": terms}
+
+
+def _shard_file(kind, data):
+    """Serialize a shard and name it after its content."""
+    output = json.dumps(data, sort_keys=True, separators=(',', ':'))
+    digest = hashlib.sha1(output.encode('utf-8')).hexdigest()[:12]
+    return '{0}-{1}.json'.format(kind, digest), output
+
+
+def shard_inverted_index(index, prefix_length, docs_per_shard):
+    """Split an inverted index into term and doc shards.
+
+    Returns the manifest and a dictionary mapping shard file names to their
+    serialized contents.
+    """
+    files = {}
+    manifest = {
+        "prefix_length": prefix_length,
+        "docs_per_shard": docs_per_shard,
+        "docs": [],
+        "terms": {},
+    }
+    docs = index["docs"]
+    for start in range(0, len(docs), docs_per_shard):
+        name, output = _shard_file("docs", docs[start:start + docs_per_shard])
+        files[name] = output
+        manifest["docs"].append(name)
+    shards = {}
+    for term, postings in index["terms"].items():
+        shards.setdefault(term[:prefix_length], {})[term] = postings
+    for prefix, terms in shards.items():
+        name, output = _shard_file("terms", terms)
+        files[name] = output
+        manifest["terms"][prefix] = name
+    return manifest, files
+
+
+def shard_names(manifest):
+    """Return the names of the shard files listed in a manifest."""
+    return manifest["docs"] + sorted(set(manifest["terms"].values()))
 
 
 class Tipue(LateTask):
@@ -53,51 +162,171 @@ class Tipue(LateTask):
 
     name = "localsearch"
 
+    def set_site(self, site):
+        super(Tipue, self).set_site(site)
+        site._GLOBAL_CONTEXT['localsearch_inverted_index'] = site.config.get('LOCALSEARCH_INVERTED_INDEX', False)
+
+    def _post_fingerprint(self, post, lang):
+        """Return a key that changes whenever the indexed data of a post may change.
+
+        It combines a hash of the post sources (including the metadata file, if
+        any), of its URL and of the settings URLs are built from, with the
+        modification time of the rendered fragment that ``post.text()`` reads.
+        """
+        digest = hashlib.sha1()
+        for path in (post.translated_source_path(lang), post.metadata_path):
+            if path and os.path.isfile(path):
+                with open(path, 'rb') as fd:
+                    digest.update(fd.read())
+        url_config = [self.site.config.get(key) for key in (
+            'SITE_URL', 'BASE_URL', 'PRETTY_URLS', 'TRANSLATIONS', 'TRANSLATIONS_PATTERN', 'INDEX_FILE',
+            'STRIP_INDEXES')]
+        digest.update(json.dumps([post.permalink(lang, absolute=True), url_config], sort_keys=True).encode('utf-8'))
+        base_path = post.translated_base_path(lang)
+        mtime = os.stat(base_path).st_mtime if os.path.exists(base_path) else 0
+        return '{0}:{1}'.format(digest.hexdigest(), mtime)
+
+    def _post_data(self, post, lang):
+        """Extract the searchable data of a single post.
+
+        The stripped text comes from the post_digest plugin when it is
+        installed, so it is shared with the templates using it.
+        """
+        digest_plugin = self.site.plugin_manager.getPluginByName('post_digest', 'ConfigPlugin')
+        if digest_plugin is not None:
+            text = digest_plugin.plugin_object.digest(post, lang)["text"]
+        else:
+            text = post.text(lang, strip_html=True)
+        text = text.replace('^', '')
+
+        data = {}
+        data["title"] = post.title(lang)
+        data["text"] = text
+        data["tags"] = ",".join(post.tags)
+        data["url"] = post.permalink(lang, absolute=True)
+        return data
+
+    def _load_fragment(self, post, lang, cache_dir, seen):
+        """Return the data of a post, re-extracting it only if the post changed.
+
+        Each post has a fragment file in ``cache_dir``, holding the extracted
+        data together with the fingerprint of the post it was extracted from.
+        """
+        name = hashlib.sha1(post.source_path.encode('utf-8')).hexdigest() + '.json'
+        fragment_path = os.path.join(cache_dir, lang, name)
+        seen.add(fragment_path)
+        fingerprint = self._post_fingerprint(post, lang)
+        if os.path.exists(fragment_path):
+            with codecs.open(fragment_path, "r", "utf8") as fd:
+                try:
+                    fragment = json.load(fd)
+                except ValueError:
+                    fragment = {}
+            if fragment.get("fingerprint") == fingerprint:
+                return fragment["data"]
+        data = self._post_data(post, lang)
+        makedirs(os.path.dirname(fragment_path))
+        with codecs.open(fragment_path, "wb+", "utf8") as fd:
+            json.dump({"fingerprint": fingerprint, "data": data}, fd)
+        return data
+
     def gen_tasks(self):
         self.site.scan_posts()
 
         kw = {
             "translations": self.site.config['TRANSLATIONS'],
             "output_folder": self.site.config['OUTPUT_FOLDER'],
+            "cache_folder": self.site.config['CACHE_FOLDER'],
             "filters": self.site.config['FILTERS'],
+            "inverted_index": self.site.config.get('LOCALSEARCH_INVERTED_INDEX', False),
+            "prefix_length": self.site.config.get('LOCALSEARCH_SHARD_PREFIX_LENGTH', 2),
+            "docs_per_shard": self.site.config.get('LOCALSEARCH_DOCS_PER_SHARD', 100),
             "timeline": self.site.timeline,
         }
 
         posts = self.site.timeline[:]
-        dst_path = os.path.join(kw["output_folder"], "assets", "js",
-                                "tipuesearch_content.js")
+        if kw["inverted_index"]:
+            dst_path = os.path.join(kw["output_folder"], "assets", "js", "search", "manifest.json")
+        else:
+            dst_path = os.path.join(kw["output_folder"], "assets", "js", "tipuesearch_content.js")
+        cache_dir = os.path.join(kw["cache_folder"], "localsearch")
+
+        def indexed(post):
+            # Don't index drafts (Issue #387)
+            return not (post.is_draft or post.is_private or post.publish_later)
 
         def save_data():
             pages = []
+            seen = set()
             for lang in kw["translations"]:
                 for post in posts:
-                    # Don't index drafts (Issue #387)
-                    if post.is_draft or post.is_private or post.publish_later:
-                        continue
-                    text = post.text(lang, strip_html=True)
-                    text = text.replace('^', '')
-
-                    data = {}
-                    data["title"] = post.title(lang)
-                    data["text"] = text
-                    data["tags"] = ",".join(post.tags)
-                    data["url"] = post.permalink(lang, absolute=True)
-                    pages.append(data)
+                    if indexed(post):
+                        pages.append(self._load_fragment(post, lang, cache_dir, seen))
+            # Drop fragments of posts that were removed or are no longer indexed
+            for root, _, files in os.walk(cache_dir):
+                for fname in files:
+                    path = os.path.join(root, fname)
+                    if path not in seen:
+                        os.unlink(path)
+            if kw["inverted_index"]:
+                save_shards(build_inverted_index(pages))
+                return
             output = json.dumps({"pages": pages}, indent=2)
             output = 'var tipuesearch = ' + output + ';'
             makedirs(os.path.dirname(dst_path))
             with codecs.open(dst_path, "wb+", "utf8") as fd:
                 fd.write(output)
 
+        def save_shards(index):
+            manifest, files = shard_inverted_index(index, kw["prefix_length"], kw["docs_per_shard"])
+            shard_dir = os.path.dirname(dst_path)
+            makedirs(shard_dir)
+            # Shards are named after their content, so unchanged ones are kept.
+            # Old ones go along with their compressed siblings.
+            for name in os.listdir(shard_dir):
+                base = name[:-3] if name.endswith(('.gz', '.br')) else name
+                if base.endswith('.json') and base.startswith(('docs-', 'terms-')) and base not in files:
+                    os.unlink(os.path.join(shard_dir, name))
+            written = []
+            for name, output in files.items():
+                path = os.path.join(shard_dir, name)
+                if not os.path.exists(path):
+                    with codecs.open(path, "wb+", "utf8") as fd:
+                        fd.write(output)
+                    written.append(path)
+            # The shards are not known when the task is created, so their
+            # filters (such as precompress) run here, on the new ones only
+            for action, args in apply_filters({"targets": written, "actions": []}, kw["filters"])["actions"]:
+                action(*args)
+            with codecs.open(dst_path, "wb+", "utf8") as fd:
+                json.dump(manifest, fd, sort_keys=True, separators=(',', ':'))
+
+        file_dep = [post.translated_base_path(lang)
+                    for lang in kw["translations"]
+                    for post in posts if indexed(post)]
+
         task = {
             "basename": str(self.name),
             "name": dst_path,
             "targets": [dst_path],
+            "file_dep": file_dep,
             "actions": [(save_data, [])],
             'uptodate': [config_changed(kw)],
             'calc_dep': ['_scan_locs:sitemap']
         }
-        yield apply_filters(task, kw['filters'])
+        task = apply_filters(task, kw['filters'])
+        if kw["inverted_index"] and os.path.exists(dst_path):
+            # Shard names depend on the index, only known once the task runs:
+            # declare those of the previous build, so that a missing shard
+            # triggers a rebuild and `nikola check --clean-files` keeps them.
+            # Filters are not applied to them, as they may be replaced.
+            with codecs.open(dst_path, "r", "utf8") as fd:
+                try:
+                    names = shard_names(json.load(fd))
+                except (ValueError, KeyError):
+                    names = []
+            task["targets"] += [os.path.join(os.path.dirname(dst_path), name) for name in names]
+        yield task
 
         # Copy all the assets to the right places
         asset_folder = os.path.join(os.path.dirname(__file__), "files")
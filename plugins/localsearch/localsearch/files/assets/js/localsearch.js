@@ -0,0 +1,270 @@
+/*
+Client for the inverted index written by the Nikola localsearch plugin
+when LOCALSEARCH_INVERTED_INDEX is enabled.
+
+The index is split into shards listed in a manifest. Only the term
+shards matching the prefixes of the query terms, and the doc shards of
+the results, are downloaded.
+
+Results are rendered with the same markup as Tipue Search, so
+tipuesearch.css applies to them as well.
+*/
+
+var localsearch = (function() {
+
+     var TOKEN_RE = /[\p{L}\p{N}\p{M}_]+/gu;
+
+     function stopWords()
+     {
+          var words = {};
+          if (typeof tipuesearch_stop_words !== 'undefined')
+          {
+               for (var i = 0; i < tipuesearch_stop_words.length; i++)
+               {
+                    words[tipuesearch_stop_words[i]] = true;
+               }
+          }
+          return words;
+     }
+
+     // Must match tokenize() in the localsearch plugin
+     function tokenize(text, stop)
+     {
+          var words = text.toLowerCase().match(TOKEN_RE) || [];
+          var tokens = [];
+          for (var i = 0; i < words.length; i++)
+          {
+               if (!stop[words[i]])
+               {
+                    tokens.push([i, words[i]]);
+               }
+          }
+          return tokens;
+     }
+
+     function escapeHtml(text)
+     {
+          return text.replace(/&/g, '&amp;').replace(/</g, '&lt;').replace(/>/g, '&gt;').replace(/"/g, '&quot;');
+     }
+
+     function getQuery()
+     {
+          var match = /[?&]q=([^&#]*)/.exec(location.search);
+          if (!match)
+          {
+               return '';
+          }
+          var query = match[1].replace(/\+/g, ' ');
+          try
+          {
+               return decodeURIComponent(query);
+          }
+          catch(e)
+          {
+               return unescape(query);
+          }
+     }
+
+     // Return {doc_id: [positions]} for docs where all query tokens appear
+     // at the same relative positions as in the query.
+     function matchPhrase(tokens, postings)
+     {
+          var first = {};
+          var list = postings[tokens[0][1]];
+          for (var i = 0; i < list.length; i++)
+          {
+               first[list[i][0]] = list[i][1];
+          }
+          for (var t = 1; t < tokens.length; t++)
+          {
+               var shift = tokens[t][0] - tokens[0][0];
+               var next = {};
+               list = postings[tokens[t][1]];
+               for (var i = 0; i < list.length; i++)
+               {
+                    var doc = list[i][0];
+                    if (!(doc in first))
+                    {
+                         continue;
+                    }
+                    var positions = {};
+                    for (var p = 0; p < list[i][1].length; p++)
+                    {
+                         positions[list[i][1][p] - shift] = true;
+                    }
+                    var kept = first[doc].filter(function(p) { return positions[p]; });
+                    if (kept.length)
+                    {
+                         next[doc] = kept;
+                    }
+               }
+               first = next;
+          }
+          return first;
+     }
+
+     function search(query, postings, stop)
+     {
+          var phrase = /^(["']).*\1$/.test(query);
+          var tokens = tokenize(phrase ? query.slice(1, -1) : query, stop);
+          var scores = {};
+          if (!tokens.length)
+          {
+               return [];
+          }
+          for (var t = 0; t < tokens.length; t++)
+          {
+               if (!postings[tokens[t][1]])
+               {
+                    return [];
+               }
+          }
+          if (phrase)
+          {
+               var matches = matchPhrase(tokens, postings);
+               for (var doc in matches)
+               {
+                    scores[doc] = 20 * matches[doc].length;
+               }
+          }
+          else
+          {
+               var seen = {};
+               for (var t = 0; t < tokens.length; t++)
+               {
+                    var term = tokens[t][1];
+                    if (seen[term])
+                    {
+                         continue;
+                    }
+                    seen[term] = true;
+                    var list = postings[term];
+                    var next = {};
+                    for (var i = 0; i < list.length; i++)
+                    {
+                         var doc = list[i][0];
+                         if (t === 0 || doc in scores)
+                         {
+                              next[doc] = (scores[doc] || 0) + 20 * list[i][1].length;
+                         }
+                    }
+                    scores = next;
+               }
+          }
+          var found = [];
+          for (var doc in scores)
+          {
+               found.push([scores[doc], parseInt(doc, 10)]);
+          }
+          found.sort(function(a, b) { return b[0] - a[0] || a[1] - b[1]; });
+          return found;
+     }
+
+     function fetchJson(url)
+     {
+          return fetch(url).then(function(response) {
+               return response.json();
+          });
+     }
+
+     // Fetch the term shards needed for the tokens and merge them
+     function fetchPostings(base, manifest, tokens)
+     {
+          var names = {};
+          for (var t = 0; t < tokens.length; t++)
+          {
+               var name = manifest.terms[tokens[t][1].slice(0, manifest.prefix_length)];
+               if (name)
+               {
+                    names[name] = true;
+               }
+          }
+          return Promise.all(Object.keys(names).map(function(name) {
+               return fetchJson(base + name);
+          })).then(function(shards) {
+               var postings = {};
+               for (var i = 0; i < shards.length; i++)
+               {
+                    for (var term in shards[i])
+                    {
+                         postings[term] = shards[i][term];
+                    }
+               }
+               return postings;
+          });
+     }
+
+     // Fetch the doc shards holding the results, returns {doc_id: doc}
+     function fetchDocs(base, manifest, found)
+     {
+          var blocks = {};
+          for (var i = 0; i < found.length; i++)
+          {
+               blocks[Math.floor(found[i][1] / manifest.docs_per_shard)] = true;
+          }
+          var numbers = Object.keys(blocks).map(Number);
+          return Promise.all(numbers.map(function(block) {
+               return fetchJson(base + manifest.docs[block]);
+          })).then(function(shards) {
+               var docs = {};
+               for (var i = 0; i < shards.length; i++)
+               {
+                    for (var d = 0; d < shards[i].length; d++)
+                    {
+                         docs[numbers[i] * manifest.docs_per_shard + d] = shards[i][d];
+                    }
+               }
+               return docs;
+          });
+     }
+
+     function render(container, query, found, docs)
+     {
+          var out = '';
+          if (!found.length)
+          {
+               out = '<div id="tipue_search_warning">' + (typeof tipuesearch_string_8 !== 'undefined' ? tipuesearch_string_8 : 'Nothing found') + '</div>';
+          }
+          else
+          {
+               out += '<div id="tipue_search_results_count">' + found.length + ' ' + (found.length === 1 ? 'result' : 'results') + '</div>';
+               for (var i = 0; i < found.length; i++)
+               {
+                    var doc = docs[found[i][1]];
+                    out += '<div class="tipue_search_result">';
+                    out += '<div class="tipue_search_content_title"><a href="' + escapeHtml(doc[1]) + '">' + escapeHtml(doc[0]) + '</a></div>';
+                    out += '<div class="tipue_search_content_text">' + escapeHtml(doc[3]) + '&hellip;</div>';
+                    out += '</div>';
+               }
+          }
+          container.innerHTML = out;
+     }
+
+     return function(inputSelector, contentSelector, manifestUrl)
+     {
+          var input = document.querySelector(inputSelector);
+          var container = document.querySelector(contentSelector);
+          var query = getQuery().replace(/\s\s+/g, ' ').trim();
+          if (input)
+          {
+               input.value = query;
+          }
+          if (!query || !container)
+          {
+               return;
+          }
+          var stop = stopWords();
+          var phrase = /^(["']).*\1$/.test(query);
+          var tokens = tokenize(phrase ? query.slice(1, -1) : query, stop);
+          var base = manifestUrl.slice(0, manifestUrl.lastIndexOf('/') + 1);
+          fetchJson(manifestUrl).then(function(manifest) {
+               return fetchPostings(base, manifest, tokens).then(function(postings) {
+                    var found = search(query, postings, stop);
+                    return fetchDocs(base, manifest, found).then(function(docs) {
+                         render(container, query, found, docs);
+                    });
+               });
+          });
+     };
+
+})();
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+
+# Copyright © 2022 Quansight Labs and others.
+
+# Permission is hereby granted, free of charge, to any
+# person obtaining a copy of this software and associated
+# documentation files (the "Software"), to deal in the
+# Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the
+# Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice
+# shall be included in all copies or substantial portions of
+# the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY
+# KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+# WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR
+# PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS
+# OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+# OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+# OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""Cache the stripped text, summary, word count and reading time of posts."""
+
+import codecs
+import hashlib
+import json
+import io
+import math
+import os
+import tempfile
+
+import lxml.html
+
+from nikola.plugin_categories import ConfigPlugin
+from nikola.utils import LocaleBorg, makedirs
+
+# Same as Post.reading_time
+WORDS_PER_MINUTE = 220
+EMBEDDABLES = [".//img", ".//picture", ".//video", ".//audio", ".//object", ".//iframe"]
+
+
+class PostDigest(ConfigPlugin):
+    """Compute data derived from the text of posts once, and share it.
+
+    ``digest(post, lang)`` returns a dictionary with the ``text`` of the post
+    without HTML, a ``summary`` (its first POST_DIGEST_SUMMARY_LENGTH
+    characters), its ``word_count`` and its ``reading_time`` in minutes.
+    Results are keyed by the hash of the compiled post, kept in memory and in
+    ``CACHE_FOLDER/post_digest``, so the HTML of a post is only stripped once
+    per change, whichever template or plugin asks first.
+
+    Templates get it as ``post_digest``; plugins use
+    ``site.plugin_manager.getPluginByName('post_digest', 'ConfigPlugin')``.
+    """
+
+    name = "post_digest"
+    # Bump when the computed data changes
+    cache_version = 1
+
+    def set_site(self, site):
+        super().set_site(site)
+        self._memo = {}
+        site._GLOBAL_CONTEXT['post_digest'] = self.digest
+
+    def _compute(self, post, lang, data):
+        """Compute the digest of a post, given its compiled HTML."""
+        text = post.text(lang, strip_html=True)
+        words = len(text.split())
+        media = 0
+        if data.strip():
+            try:
+                document = lxml.html.fragment_fromstring(data, "body")
+                media = sum(len(document.findall(path)) for path in EMBEDDABLES)
+            except (lxml.etree.ParserError, ValueError):
+                pass
+        return {
+            "text": text,
+            "summary": text[:self.site.config.get('POST_DIGEST_SUMMARY_LENGTH', 200)],
+            "word_count": words,
+            "reading_time": int(math.ceil(words / WORDS_PER_MINUTE + media * 0.33)) or 1,
+        }
+
+    def digest(self, post, lang=None):
+        """Return the derived data of a post."""
+        if lang is None:
+            lang = LocaleBorg().current_lang
+        path = post.translated_base_path(lang)
+        if not os.path.isfile(path):
+            # Post.text() compiles the post in that case
+            post.text(lang)
+        with codecs.open(path, "r", "utf-8-sig") as fd:
+            data = fd.read()
+
+        key = hashlib.sha1(json.dumps([
+            self.cache_version, self.site.config.get('POST_DIGEST_SUMMARY_LENGTH', 200), post.hyphenate,
+        ]).encode('utf-8'))
+        key.update(data.encode('utf-8'))
+        key = key.hexdigest()
+        if key in self._memo:
+            return self._memo[key]
+
+        cache_path = os.path.join(self.site.config['CACHE_FOLDER'], 'post_digest', key[:2], key + '.json')
+        result = None
+        if os.path.exists(cache_path):
+            with codecs.open(cache_path, "r", "utf8") as fd:
+                try:
+                    result = json.load(fd)
+                except ValueError:
+                    result = None
+        if result is None:
+            result = self._compute(post, lang, data)
+            makedirs(os.path.dirname(cache_path))
+            # A temporary file of its own: parallel builds may digest the same post
+            handle, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(cache_path))
+            try:
+                with io.open(handle, "w", encoding="utf8") as fd:
+                    json.dump(result, fd)
+                os.replace(tmp_path, cache_path)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.unlink(tmp_path)
+        self._memo[key] = result
+        return result
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+# Copyright © 2022 Quansight Labs and others.
+
+# Permission is hereby granted, free of charge, to any
+# person obtaining a copy of this software and associated
+# documentation files (the "Software"), to deal in the
+# Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the
+# Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice
+# shall be included in all copies or substantial portions of
+# the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY
+# KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+# WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR
+# PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS
+# OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+# OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+# OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""Write gzip and brotli compressed copies of the text files in the output."""
+
+import gzip
+import os
+
+try:
+    import brotli
+except ImportError:
+    brotli = None  # NOQA
+
+from nikola.plugin_categories import Task
+from nikola.utils import req_missing
+
+
+def compress_file(path, formats, min_size=0):
+    """Write the compressed siblings of a file.
+
+    Files smaller than min_size are not compressed, and lose the siblings
+    of a previous version.
+    """
+    with open(path, 'rb') as fd:
+        data = fd.read()
+    for fmt in formats:
+        if len(data) < min_size and os.path.exists(path + '.' + fmt):
+            os.unlink(path + '.' + fmt)
+    if len(data) < min_size:
+        return
+    if 'gz' in formats:
+        with open(path + '.gz', 'wb') as fd:
+            # A fixed mtime keeps the output identical for identical input
+            with gzip.GzipFile(filename='', mode='wb', fileobj=fd, compresslevel=9, mtime=0) as gz:
+                gz.write(data)
+    if 'br' in formats:
+        with open(path + '.br', 'wb') as fd:
+            fd.write(brotli.compress(data, quality=11))
+
+
+class Precompress(Task):
+    """Write compressed copies of text files in the output folder."""
+
+    name = "precompress"
+
+    def set_site(self, site):
+        site.register_filter('precompress', self.precompress)
+        super().set_site(site)
+        self.formats = list(site.config.get('PRECOMPRESS_FORMATS', ['gz', 'br']))
+        self.min_size = site.config.get('PRECOMPRESS_MIN_SIZE', 1024)
+
+    def precompress(self, filename):
+        """Write the compressed siblings of a file.
+
+        This is registered as the ``precompress`` filter. It runs in the
+        tasks writing the files, so only files written again are compressed.
+        """
+        if 'br' in self.formats and brotli is None:
+            req_missing(['brotli'], 'write brotli compressed files', optional=True)
+            self.formats.remove('br')
+        compress_file(filename, self.formats, self.min_size)
+
+    def gen_tasks(self):
+        yield self.group_task()
@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+
+# Copyright © 2022 Quansight Labs and others.
+
+# Permission is hereby granted, free of charge, to any
+# person obtaining a copy of this software and associated
+# documentation files (the "Software"), to deal in the
+# Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the
+# Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice
+# shall be included in all copies or substantial portions of
+# the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY
+# KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+# WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR
+# PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS
+# OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+# OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+# OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""Write resized WebP/AVIF variants of images and serve them with <picture>."""
+
+import hashlib
+import html
+import io
+import os
+import posixpath
+import re
+import shutil
+import tempfile
+from urllib.parse import unquote, urlsplit
+
+from PIL import Image
+
+try:
+    import pillow_avif  # NOQA registers the AVIF codec with Pillow
+except ImportError:
+    pillow_avif = None  # NOQA
+
+from nikola.plugin_categories import Task
+from nikola import utils
+
+RASTER_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+MIME_TYPES = {'avif': 'image/avif', 'webp': 'image/webp'}
+IMG_RE = re.compile(r'<img\b[^>]*>', re.IGNORECASE)
+SRC_RE = re.compile(r'''\ssrc\s*=\s*(["'])(.*?)\1''', re.IGNORECASE | re.DOTALL)
+
+
+def variant_name(path, width, fmt):
+    """Return the name of a variant of an image, next to the image itself."""
+    return '{0}.{1}w.{2}'.format(path, width, fmt)
+
+
+def encode_variant(src, dest, width, fmt, quality):
+    """Write a resized copy of an image in another format."""
+    with Image.open(src) as im:
+        if im.mode not in ('RGB', 'RGBA'):
+            alpha = 'A' in im.getbands() or 'transparency' in im.info
+            im = im.convert('RGBA' if alpha else 'RGB')
+        if im.width != width:
+            height = max(1, round(im.height * width / im.width))
+            im = im.resize((width, height), Image.LANCZOS)
+        # A unique temporary name: identical images may be encoded in parallel
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(dest))
+        os.close(fd)
+        try:
+            im.save(tmp, fmt.upper(), quality=quality)
+            os.replace(tmp, dest)
+        finally:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+    return dest
+
+
+class ResponsiveImages(Task):
+    """Write resized WebP/AVIF variants of the images in IMAGE_FOLDERS."""
+
+    name = "responsive_images"
+
+    def set_site(self, site):
+        self._sizes = {}
+        formats = list(site.config.get('RESPONSIVE_IMAGE_FORMATS', ['avif', 'webp']))
+        if 'avif' in formats and 'AVIF' not in Image.SAVE:
+            utils.req_missing(['pillow-avif-plugin'], 'write AVIF images', optional=True)
+            formats.remove('avif')
+        self.formats = formats
+        site.register_filter('responsive_images', self.rewrite_html)
+        return super().set_site(site)
+
+    def _full_width(self, src):
+        """Return the width of an image once scaled down to MAX_IMAGE_SIZE."""
+        mtime = os.stat(src).st_mtime
+        cached = self._sizes.get(src)
+        if cached is None or cached[0] != mtime:
+            # Opening an image only reads its header
+            with Image.open(src) as im:
+                width, height = im.size
+            max_size = self.site.config['MAX_IMAGE_SIZE']
+            if max(width, height) > max_size:
+                width = max(1, int(width * max_size / max(width, height)))
+            cached = self._sizes[src] = (mtime, width)
+        return cached[1]
+
+    def variants(self, src):
+        """Return the (width, format) variants to write for a source image."""
+        full = self._full_width(src)
+        widths = self.site.config.get('RESPONSIVE_IMAGE_WIDTHS', [480, 960])
+        widths = sorted(set(w for w in widths if w < full) | {full})
+        return [(width, fmt) for fmt in self.formats for width in widths]
+
+    def _source_images(self):
+        """Yield (source path, path relative to the output folder) of all images."""
+        for src_dir, dst_dir in self.site.config['IMAGE_FOLDERS'].items():
+            for root, _, files in os.walk(src_dir):
+                for fname in sorted(files):
+                    if os.path.splitext(fname)[1].lower() not in RASTER_EXTENSIONS:
+                        continue
+                    src = os.path.join(root, fname)
+                    yield src, os.path.join(dst_dir, os.path.relpath(src, src_dir))
+
+    def write_variants(self, src, variants, kw):
+        """Copy the variants of an image from the cache, encoding the missing ones.
+
+        Encoded variants are cached by the hash of their source, so renaming
+        or touching an image does not encode it again.
+        """
+        with open(src, 'rb') as fd:
+            digest = hashlib.sha1(fd.read()).hexdigest()
+        for width, fmt, dest in variants:
+            cached = os.path.join(kw['cache_folder'], digest[:2], '{0}.{1}w.q{2}.{3}'.format(
+                digest, width, kw['quality'], fmt))
+            if not os.path.exists(cached):
+                utils.makedirs(os.path.dirname(cached))
+                encode_variant(src, cached, width, fmt, kw['quality'])
+            utils.makedirs(os.path.dirname(dest))
+            shutil.copyfile(cached, dest)
+
+    def gen_tasks(self):
+        kw = {
+            'image_folders': self.site.config['IMAGE_FOLDERS'],
+            'output_folder': self.site.config['OUTPUT_FOLDER'],
+            'cache_folder': os.path.join(self.site.config['CACHE_FOLDER'], 'responsive_images'),
+            'max_image_size': self.site.config['MAX_IMAGE_SIZE'],
+            'widths': self.site.config.get('RESPONSIVE_IMAGE_WIDTHS', [480, 960]),
+            'formats': self.formats,
+            'quality': self.site.config.get('RESPONSIVE_IMAGE_QUALITY', 80),
+            'filters': self.site.config['FILTERS'],
+        }
+        if not kw['formats']:
+            return
+
+        yield self.group_task()
+        # One task per image, so that doit only encodes changed images, in parallel
+        for src, rel_path in self._source_images():
+            variants = []
+            for width, fmt in self.variants(src):
+                variants.append((width, fmt, os.path.join(kw['output_folder'], variant_name(rel_path, width, fmt))))
+            yield utils.apply_filters({
+                'basename': self.name,
+                'name': rel_path,
+                'file_dep': [src],
+                'targets': [dest for _, _, dest in variants],
+                'actions': [(self.write_variants, (src, variants, kw))],
+                'uptodate': [utils.config_changed(kw, 'responsive_images:variants')],
+                'clean': True,
+            }, kw['filters'])
+
+    def _source_for_url(self, url, page_dir):
+        """Return the source image a URL in a page points to, or None."""
+        parts = urlsplit(url)
+        site = urlsplit(self.site.config['SITE_URL'])
+        if parts.netloc and parts.netloc != site.netloc:
+            return None
+        path = unquote(parts.path)
+        if path.startswith('/'):
+            root = site.path if site.path.endswith('/') else site.path + '/'
+            if not path.startswith(root):
+                return None
+            path = path[len(root):]
+        else:
+            path = posixpath.normpath(posixpath.join(page_dir, path))
+        for src_dir, dst_dir in self.site.config['IMAGE_FOLDERS'].items():
+            prefix = dst_dir.strip('/') + '/'
+            if path.startswith(prefix):
+                src = os.path.join(src_dir, *path[len(prefix):].split('/'))
+                if os.path.splitext(src)[1].lower() in RASTER_EXTENSIONS and os.path.isfile(src):
+                    return src
+        return None
+
+    def rewrite_html(self, filename):
+        """Wrap <img> tags pointing to IMAGE_FOLDERS in <picture> elements.
+
+        This is registered as the ``responsive_images`` filter.
+        """
+        if not self.formats:
+            return
+        with io.open(filename, 'r', encoding='utf-8') as fd:
+            data = fd.read()
+        rel_path = os.path.relpath(filename, self.site.config['OUTPUT_FOLDER'])
+        page_dir = posixpath.dirname(rel_path.replace(os.sep, '/'))
+        sizes = self.site.config.get('RESPONSIVE_IMAGE_SIZES', '(max-width: {width}px) 100vw, {width}px')
+
+        def replace(match):
+            tag = match.group(0)
+            start = match.start()
+            if data.rfind('<picture', 0, start) > data.rfind('</picture>', 0, start):
+                return tag
+            src_match = SRC_RE.search(tag)
+            if src_match is None:
+                return tag
+            url = html.unescape(src_match.group(2))
+            src = self._source_for_url(url, page_dir)
+            if src is None:
+                return tag
+            base = urlsplit(url).path
+            sources = []
+            for fmt in self.formats:
+                srcset = ', '.join('{0} {1}w'.format(html.escape(variant_name(base, width, f)), width)
+                                   for width, f in self.variants(src) if f == fmt)
+                sources.append('<source type="{0}" srcset="{1}" sizes="{2}">'.format(
+                    MIME_TYPES[fmt], srcset, sizes.format(width=self._full_width(src))))
+            return '<picture>{0}{1}</picture>'.format(''.join(sources), tag)
+
+        new_data = IMG_RE.sub(replace, data)
+        if new_data != data:
+            with io.open(filename, 'w+', encoding='utf-8') as fd:
+                fd.write(new_data)
@@ -4,9 +4,23 @@
 import os
 import re
 import sys
+import json
+import pickle
+import hashlib
 import argparse
+import tempfile
 import subprocess
 
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+# Declarations whose value is formatted as: name 'signature' rest
+SIGNATURE_DECLS = ['TypedefDecl', 'CXXMethodDecl', 'CXXConstructorDecl', 'CXXDestructorDecl',
+                   'ParmVarDecl', 'TypeAliasDecl', 'EnumConstantDecl', 'FunctionDecl',
+                   'VarDecl', 'FieldDecl', 'IndirectFieldDecl', 'UnresolvedUsingValueDecl',
+                   ]
 
 class Node:
     """Node represents a pair of key and value.
@@ -15,14 +29,16 @@ class Node:
     All non-root nodes have parents.
     """
 
+    # Translation units have up to millions of nodes, keep them small
+    __slots__ = ('parent', 'prefix', 'key', 'loc', 'value', 'nodes')
+
     def __init__(self, parent, prefix, key, value):
         assert isinstance(parent, (Node, type(None)))
         assert isinstance(key, str), key
         assert isinstance(value, str), value
         self.parent = parent
-        self.prefix = prefix  # used only when parsing clang dump output
-        self.key = key
-        self._value = value   # original value, unused
+        self.prefix = sys.intern(prefix)  # used only when parsing clang dump output
+        self.key = key = sys.intern(key)
         self.loc = get_path(value)
 
         if key == 'TranslationUnitDecl':
@@ -30,16 +46,14 @@ class Node:
         elif key in ['NamespaceDecl', 'AccessSpecDecl', 'LinkageSpecDecl']:
             # take last word
             value = value.rsplit(None, 1)[-1]
-        elif key in ['TypedefDecl', 'CXXMethodDecl', 'CXXConstructorDecl', 'CXXDestructorDecl',
-                     'ParmVarDecl', 'TypeAliasDecl', 'EnumConstantDecl', 'FunctionDecl',
-                     'VarDecl', 'FieldDecl', 'IndirectFieldDecl', 'UnresolvedUsingValueDecl',
-                     ]:
+        elif key in SIGNATURE_DECLS:
             # name 'signature' rest
             # warning: pre-name part may be relevant as well
             i = value.find("'")
             j = value.rfind("'")
             assert -1 not in {i, j}, (key, value)
-            name = value[:i].rstrip().rsplit(None, 1)[-1]
+            words = value[:i].split()
+            name = words[-1] if words else ''
             if key == 'ParmVarDecl' and ':' in name:
                 name = ''
             sig = value[i:j+1]
@@ -63,7 +77,13 @@ class Node:
             print(f'TODO[{key}]: {value}')
             assert "'" not in value
         self.value = value
-        self.nodes = []
+        self.nodes = ()  # a list once the node has children
+
+    def append(self, node):
+        if self.nodes:
+            self.nodes.append(node)
+        else:
+            self.nodes = [node]
 
     def __repr__(self):
         return f'{self.key}({self.value!r})'
@@ -94,13 +114,34 @@ class Node:
     def iter(self, key, reversed=False):
         return self.traverse(lambda node: node.key == key, reversed=reversed)
 
-    def cleanup(self):
+    def is_excluded(self):
+        """Return True when the node and all its children are not wrapped.
+
+        This only depends on the node itself, so that parse_ast_dump can
+        skip the whole subtree while parsing.
+        """
         if self.key == 'NamespaceDecl':
             if self.value == 'std' or self.value.startswith('_'):
-                return
+                return True
         if self.key in ['FunctionDecl', 'TypedefDecl']:
             if self.value.startswith('_') or self.value.split(None, 1)[0] in ['new', 'delete', 'new[]', 'delete[]']:
-                return
+                return True
+        if self.loc is not None:
+            if self.loc.startswith(sys.prefix):
+                return True
+        if self.key in ['EnumDecl', 'TypedefDecl']:
+            return True
+        if self.key == 'CXXRecordDecl' and (self.value == '...' or self.value.split(None, 1)[-1].startswith('_')):
+            return True
+        return False
+
+    def cleanup(self):
+        """Remove what is not wrapped from the tree, in place.
+
+        Returns the node, or None when the node itself is removed.
+        """
+        if self.is_excluded():
+            return
         nodes = []
         public = True
         for node in self.nodes:
@@ -116,56 +157,403 @@ class Node:
         if self.key in ['LinkageSpecDecl'] and not nodes:
             return
 
-        if self.loc is not None:
-            if self.loc.startswith(sys.prefix):
-                return
-
-        if self.key in ['EnumDecl', 'TypedefDecl']:
-            return
-
-        if self.key == 'CXXRecordDecl' and (self.value == '...' or self.value.split(None, 1)[-1].startswith('_')):
-            return
-        
-        obj = object.__new__(Node)
-        obj.parent = self.parent
-        obj.key = self.key
-        obj.value = self.value
-        obj._value = self._value
-        obj.nodes = nodes
-        obj.loc = self.loc
-        return obj
+        self.nodes = nodes or ()
+        return self
 
 
 def get_path(value):
     m = re.match(r'.*[<]([^\s]*[.](hpp|hxx|h))[:]\d+[:]\d+', value)
     if m is not None:
         p = m.group(1)
-        return p
+        return sys.intern(p)
 
     
 def parse_ast_dump(ast_dump_output):
     """Parse clang ast dump output into a Node tree.
+
+    ast_dump_output is either the whole output or an iterable of its
+    lines, such as a pipe from clang, so that the dump never needs to be
+    held in memory.
     """
-    for line in ast_dump_output.splitlines():
+    if isinstance(ast_dump_output, str):
+        ast_dump_output = ast_dump_output.splitlines()
+    root = None
+    skip = None       # prefix length of the subtree being skipped
+    private = set()   # nodes whose next children are private members
+    for line in ast_dump_output:
+        line = line.rstrip('\n')
         prefix, rest = line.split('-', 1) if '-' in line else ('', line)
+        if skip is not None:
+            if len(prefix) > skip:
+                continue
+            skip = None
         lst = rest.split(None, 1)
         key, value = lst if len(lst) == 2 else (lst[0], '')
         if not prefix:
             root = current = Node(None, prefix, key, value)
+            continue
+        if len(current.prefix) < len(prefix):
+            parent = current
         else:
-            if len(current.prefix) < len(prefix):
-                node = Node(current, prefix, key, value)
-                current.nodes.append(node)
+            while len(current.prefix) > len(prefix):
+                current = current.parent
+            assert current.prefix[:-1] == prefix[:-1], (current.prefix, prefix)
+            parent = current.parent
+        node = Node(parent, prefix, key, value)
+        if key == 'AccessSpecDecl':
+            if node.value == 'public':
+                private.discard(parent)
             else:
-                while len(current.prefix) > len(prefix):
-                    current = current.parent
-                assert current.prefix[:-1] == prefix[:-1], (current.prefix, prefix)
-                node = Node(current.parent, prefix, key, value)
-                current.parent.nodes.append(node)
-            current = node
+                private.add(parent)
+        # Skip what cleanup would discard, such as std namespaces and
+        # system headers, without building the subtree
+        if parent in private or node.is_excluded():
+            skip = len(prefix)
+            continue
+        parent.append(node)
+        current = node
+    if root is not None:
+        return root.cleanup()
+
+
+def json_node_value(kind, fields):
+    """Format the fields of a node of clang's JSON AST dump like its text dump.
+
+    The result is what follows the node address in the text dump, as
+    expected by Node. The locations must have been completed by
+    track_locations.
+    """
+    begin = fields.get('range', {}).get('begin', {})
+    begin = begin.get('spellingLoc', begin)  # in macro expansions
+    loc = fields.get('loc', {})
+    loc = loc.get('spellingLoc', loc)
+    words = []
+    if 'file' in begin:
+        words.append('<{}:{}:{}>'.format(begin['file'], begin.get('line', 0), begin.get('col', 0)))
+    name = fields.get('name', '')
+    if kind == 'AccessSpecDecl':
+        words.append(fields.get('access', ''))
+    elif kind == 'LinkageSpecDecl':
+        words.append(fields.get('language', ''))
+    elif kind == 'CXXRecordDecl':
+        words.append(fields.get('tagUsed', ''))
+        words.append(name)
+        if fields.get('completeDefinition'):
+            words.append('definition')
+    elif kind in SIGNATURE_DECLS:
+        # the text dump shows the location of unnamed declarations instead
+        words.append(name or 'col:{}'.format(loc.get('col', 0)))
+        words.append("'{}'".format(fields.get('type', {}).get('qualType', '')))
+        if 'storageClass' in fields:
+            words.append(fields['storageClass'])
+        words.extend(attr for attr in ['inline', 'virtual', 'pure'] if fields.get(attr))
+    elif kind != 'TranslationUnitDecl':
+        words.append(name)
+    return ' '.join(words)
+
+
+def track_locations(last, location):
+    """Complete the file and line of a location of clang's JSON AST dump.
+
+    clang only writes the file and line of a location when they differ
+    from the previously written location, last holds them.
+    """
+    for loc in [location.get('spellingLoc'), location.get('expansionLoc'), location]:
+        if loc is None or 'col' not in loc:
+            continue
+        if 'file' in loc:
+            last['file'] = loc['file']
+        elif last['file'] is not None:
+            loc['file'] = last['file']
+        if 'line' in loc:
+            last['line'] = loc['line']
+        else:
+            loc['line'] = last['line']
+
+
+# Declarations a filtered dump may have at the top
+FILTER_DECLS = ['NamespaceDecl', 'CXXRecordDecl', 'FunctionDecl']
+
+
+def is_global_declaration(kind, fields, name, mangled=None):
+    """Return whether a declaration of a filtered dump is the global one named name.
+
+    clang dumps the outermost declarations whose qualified name contains
+    the filter, without their context: for the filter add, both ns::add
+    and a member S::add. The qualified name is not in the dump, but the
+    mangled name of functions holds it. Namespaces and classes are
+    checked against mangled, the first mangled name found inside them,
+    when there is one.
+
+    >>> is_global_declaration('FunctionDecl', {'name': 'add', 'mangledName': '_Z3addii'}, 'add')
+    True
+    >>> is_global_declaration('FunctionDecl', {'name': 'add', 'mangledName': 'add'}, 'add')  # extern "C"
+    True
+    >>> is_global_declaration('FunctionDecl', {'name': 'add', 'mangledName': '_ZN2ns3addEii'}, 'add')
+    False
+    >>> is_global_declaration('CXXMethodDecl', {'name': 'add', 'mangledName': '_ZN1S3addEii'}, 'add')
+    False
+    >>> is_global_declaration('NamespaceDecl', {'name': 'ns'}, 'ns', '_ZN2ns3addEii')
+    True
+    >>> is_global_declaration('NamespaceDecl', {'name': 'ns'}, 'ns', '_ZN5outer2ns3addEii')
+    False
+    >>> is_global_declaration('CXXRecordDecl', {'name': 'S'}, 'S', '_ZNK1S3getEv')
+    True
+    """
+    if kind not in FILTER_DECLS or fields.get('name') != name:
+        return False
+    prefix = '{}{}'.format(len(name), name)
+    if kind == 'FunctionDecl':
+        mangled = fields.get('mangledName', name)
+        return mangled == name or re.match(r'_ZL?' + prefix, mangled) is not None
+    return mangled is None or re.match(r'_ZN[rVKRO]*' + prefix, mangled) is not None
+
+
+def json_events(stream):
+    """Return the ijson.basic_parse events of a stream of JSON values.
+
+    Without ijson, the whole stream is read and decoded first.
+    """
+    if ijson is not None:
+        return ijson.basic_parse(stream, multiple_values=True)
+
+    def walk(obj):
+        if isinstance(obj, dict):
+            yield 'start_map', None
+            for key, value in obj.items():
+                yield 'map_key', key
+                yield from walk(value)
+            yield 'end_map', None
+        elif isinstance(obj, list):
+            yield 'start_array', None
+            for value in obj:
+                yield from walk(value)
+            yield 'end_array', None
+        else:
+            yield 'value', obj
+
+    def values(text):
+        decoder = json.JSONDecoder()
+        pos = 0
+        while True:
+            match = re.compile(r'\s*').match(text, pos)
+            if match.end() == len(text):
+                return
+            obj, pos = decoder.raw_decode(text, match.end())
+            yield from walk(obj)
+
+    return values(stream.read().decode('utf-8', errors='replace'))
+
+
+def parse_ast_json(stream, name=None, root=None):
+    """Parse clang -ast-dump=json output into a Node tree.
+
+    stream is a binary file, such as a pipe from clang. Nodes are built
+    while the dump is read, and the subtrees that cleanup would discard
+    are skipped.
+
+    With -ast-dump-filter, clang dumps the outermost declarations whose
+    qualified name contains the filter, without their context. Only the
+    global ones named after the filter are kept, see
+    is_global_declaration. Their nodes are added to root, so that the
+    dumps of several filters can be merged.
+    """
+    events = iter(json_events(stream))
+    if root is None:
+        root = Node(None, '', 'TranslationUnitDecl', '')
+    private = set()   # nodes whose next children are private members
+    last = dict(file=None, line=0)  # of the previous location, see track_locations
+    top_mangled = [None]  # first mangled name in the current top-level declaration
+
+    def skip(event, value):
+        # Skipped locations still change the file of the next ones
+        keys = []
+        key = None
+        while True:
+            if event in ('start_map', 'start_array'):
+                keys.append(key)
+            elif event in ('end_map', 'end_array'):
+                keys.pop()
+            elif event == 'map_key':
+                key = value
+            elif key == 'file' and 'includedFrom' not in keys:
+                last['file'] = value
+            if not keys:
+                return
+            event, value = next(events)
+
+    def read_value(event, value):
+        if event == 'start_map':
+            obj = {}
+            for event, key in events:
+                if event == 'end_map':
+                    return obj
+                obj[key] = read_value(*next(events))
+        if event == 'start_array':
+            lst = []
+            for event, value in events:
+                if event == 'end_array':
+                    return lst
+                lst.append(read_value(event, value))
+        return value
+
+    def create(parent, fields, top):
+        kind = fields.get('kind', '')
+        node = Node(parent, '', kind, json_node_value(kind, fields))
+        if top_mangled[0] is None and fields.get('mangledName', '').startswith('_Z'):
+            top_mangled[0] = fields['mangledName']
+        if kind == 'AccessSpecDecl':
+            if node.value == 'public':
+                private.discard(parent)
+            else:
+                private.add(parent)
+        if top and name is not None and (kind not in FILTER_DECLS or fields.get('name') != name):
+            return node, False
+        return node, not (parent in private or node.is_excluded())
+
+    def read_node(parent, top=False):
+        # clang writes the children of a node, in 'inner', last
+        fields = {}
+        node = keep = None
+        if top:
+            top_mangled[0] = None
+        for event, key in events:
+            if event == 'end_map':
+                break
+            event, value = next(events)
+            if key == 'inner':
+                if node is None:
+                    node, keep = create(parent, fields, top)
+                if not keep:
+                    skip(event, value)
+                    continue
+                for event, value in events:
+                    if event == 'end_array':
+                        break
+                    read_node(node)
+            elif key in ('loc', 'range', 'type'):
+                fields[key] = read_value(event, value)
+                if key == 'loc':
+                    track_locations(last, fields[key])
+                elif key == 'range':
+                    track_locations(last, fields[key].get('begin', {}))
+                    track_locations(last, fields[key].get('end', {}))
+            elif event in ('start_map', 'start_array'):
+                skip(event, value)
+            else:
+                fields[key] = value
+        if node is None:
+            node, keep = create(parent, fields, top)
+        if keep and top and name is not None:
+            # Namespaces and classes are only known to be global once read
+            keep = is_global_declaration(node.key, fields, name, top_mangled[0])
+        if keep:
+            parent.append(node)
+
+    for event, value in events:
+        if event == 'start_map':
+            read_node(root, top=True)
+    if len(root.nodes) == 1 and root.nodes[0].key == 'TranslationUnitDecl':
+        # A dump without filter
+        root = root.nodes[0]
+        root.parent = None
     return root.cleanup()
 
 
+def run_clang(cmd, parse, text=True):
+    """Run clang and return the result of parse on its output.
+
+    The output is parsed while clang writes it. stderr goes to a file: a
+    pipe that is not read could fill up and block clang.
+    """
+    with tempfile.TemporaryFile() as stderr:
+        options = dict(encoding='utf-8', errors='replace') if text else {}
+        with subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=stderr, **options) as proc:
+            result = parse(proc.stdout)
+        if proc.returncode:
+            stderr.seek(0)
+            print(stderr.read().decode())
+            sys.exit(proc.returncode)
+    return result
+
+
+def file_hash(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def read_depfile(path):
+    """Return the dependencies of the make rule written by clang -MMD.
+    """
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        text = f.read().replace('\\\n', ' ')
+    deps = text.split(':', 1)[1] if ':' in text else ''  # FIXME: win
+    return [dep.replace('\\ ', ' ') for dep in re.split(r'(?<!\\)\s+', deps.strip()) if dep]
+
+
+def ast_cache_key(args, header_files):
+    """Return the cache key of the AST of the headers.
+
+    The key covers everything the AST depends on except the content of
+    the headers, which is checked against the cache entry: it may include
+    other headers.
+    """
+    version = subprocess.run([args.clang_exe, '--version'], capture_output=True).stdout.decode(errors='replace')
+    key = [file_hash(__file__), sys.prefix, os.getcwd(), version, args.clang_ast_dump_format,
+           args.clang_ast_dump_filter, args.clang_ast_dump_flags, args.clang_extra_flags,
+           [os.path.abspath(fn) for fn in header_files]]
+    return hashlib.sha256(json.dumps(key).encode()).hexdigest()
+
+
+def load_cached_ast(path):
+    """Return the AST cached in path, or None if missing or any header changed.
+    """
+    try:
+        with open(path, 'rb') as f:
+            entry = pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return None
+    for dep, digest in entry['deps'].items():
+        if not os.path.exists(dep) or file_hash(dep) != digest:
+            return None
+    return entry['ast']
+
+
+def save_cached_ast(path, ast, deps):
+    entry = dict(deps={dep: file_hash(dep) for dep in deps}, ast=ast)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # A temporary file of its own: concurrent runs may save the same key
+    fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(entry, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+
+
+def write_if_changed(filename, content, verbose=False):
+    """Write content to filename, unless the file already holds it.
+
+    Unchanged files keep their mtime, so that build tools do not rebuild
+    what depends on them.
+    """
+    if os.path.exists(filename):
+        with open(filename) as f:
+            if f.read() == content:
+                if verbose:
+                    print(f'Keeping unchanged {filename}')
+                return False
+    if verbose:
+        print(f'Creating {filename}')
+    with open(filename, 'w') as f:
+        f.write(content)
+    return True
+
+
 python_module_tmpl = '''
 # This Python module `{modulename}` is auto-generated using cxx2py tool!
 __all__ = []
@@ -199,27 +587,48 @@ extern "C" intptr_t get_{ns_fname}_address() {{
 
 def main():
 
+    ast_dump_flags = dict(text='-Xclang -ast-dump -fsyntax-only -fno-diagnostics-color',
+                          json='-Xclang -ast-dump=json -fsyntax-only')
+
     parser = argparse.ArgumentParser(description='Generate ctypes wrappers to C++ library functions')
     parser.add_argument('-m', '--modulename', type=str, default='untitled',
                         help='Python module name of ctypes wrappers (default: %(default)s)')
     parser.add_argument('file', type=str, nargs='+', help='C++ header/source file')
     parser.add_argument('--clang-exe', type=str, default='clang++',
                         help='Path to clang compiler (default: %(default)s)')
+    parser.add_argument('--clang-ast-dump-format', choices=['text', 'json'], default='text',
+                        help='Format of clang ast dump, json is faster with filters (default: %(default)s)')
+    parser.add_argument('--clang-ast-dump-filter', type=str, action='append', metavar='NAME',
+                        help='With json format, only dump the global namespace, function or class NAME;'
+                        ' can be repeated (default: dump everything)')
     parser.add_argument('--clang-ast-dump-flags',
-                        type=str, default='-Xclang -ast-dump -fsyntax-only -fno-diagnostics-color',
-                        help='Override flags to clang ast dump command (default: %(default)r)')
+                        type=str, default=None,
+                        help='Override flags to clang ast dump command (default: %r for text, %r for json)'
+                        % (ast_dump_flags['text'], ast_dump_flags['json']))
     parser.add_argument('--clang-build-flags',
                         type=str, default='-shared -fPIC',
                         help='Override flags to clang build shared library command (default: %(default)r)')
     parser.add_argument('--clang-extra-flags',
                         type=str, default='',
                         help='Extra flags to clang command (default: %(default)r)')
+    parser.add_argument('--cache-dir', type=str,
+                        default=os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'cxx2py'),
+                        help='Directory of cached ASTs (default: %(default)s)')
+    parser.add_argument('--no-cache', default=False, action='store_true',
+                        help='Always run clang ast dump, do not use cached ASTs (default: %(default)s)')
     parser.add_argument('--build', default=False, action='store_true',
                         help='Build shared library (default: %(default)s)')
     parser.add_argument('--verbose', default=False, action='store_true',
                         help='Be verbose (default: %(default)s)')
 
     args = parser.parse_args()
+    if args.clang_ast_dump_filter and args.clang_ast_dump_format != 'json':
+        parser.error('--clang-ast-dump-filter requires --clang-ast-dump-format=json')
+    if any('::' in name for name in args.clang_ast_dump_filter or []):
+        # The context of filtered declarations is not dumped
+        parser.error('--clang-ast-dump-filter takes the name of a global declaration, filter on its namespace instead')
+    if args.clang_ast_dump_flags is None:
+        args.clang_ast_dump_flags = ast_dump_flags[args.clang_ast_dump_format]
 
     if args.verbose:
         print(args)
@@ -236,18 +645,42 @@ def main():
 
     source_files.append(cpp_filename)  # FIXME: use tmp location
 
-    clang_ast_dump_cmd = [args.clang_exe] + args.clang_ast_dump_flags.split() + args.clang_extra_flags.split() + header_files
-
-    # Parse C++ files using clang AST dump
-    if args.verbose:
-        print(' '.join(clang_ast_dump_cmd))
-
-    output = subprocess.run(clang_ast_dump_cmd, capture_output=True)
-    if output.returncode:
-        print(output.stderr.decode())
-        sys.exit(output.returncode)
+    # Reuse the AST of the previous run when nothing it depends on changed
+    ast = cache_path = None
+    if not args.no_cache:
+        cache_path = os.path.join(args.cache_dir, ast_cache_key(args, header_files) + '.pickle')
+        ast = load_cached_ast(cache_path)
+        if args.verbose:
+            print(f'{"Using" if ast is not None else "Missed"} cached AST {cache_path}')
+
+    if ast is None:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            # clang lists the project headers included by the headers in depfile
+            depfile = os.path.join(tmpdir, 'deps.d')
+            deps = set(os.path.abspath(fn) for fn in header_files)
+            clang_ast_dump_cmd = ([args.clang_exe] + args.clang_ast_dump_flags.split() + args.clang_extra_flags.split()
+                                  + ['-MMD', '-MF', depfile] + header_files)
+
+            # Parse C++ files using clang AST dump
+            if args.clang_ast_dump_format == 'json' and args.clang_ast_dump_filter:
+                # clang takes a single filter
+                for name in args.clang_ast_dump_filter:
+                    cmd = clang_ast_dump_cmd[:1] + ['-Xclang', '-ast-dump-filter', '-Xclang', name] + clang_ast_dump_cmd[1:]
+                    if args.verbose:
+                        print(' '.join(cmd))
+                    ast = run_clang(cmd, lambda stream: parse_ast_json(stream, name, ast), text=False)
+                    deps.update(os.path.abspath(dep) for dep in read_depfile(depfile))
+            else:
+                if args.verbose:
+                    print(' '.join(clang_ast_dump_cmd))
+                if args.clang_ast_dump_format == 'json':
+                    ast = run_clang(clang_ast_dump_cmd, parse_ast_json, text=False)
+                else:
+                    ast = run_clang(clang_ast_dump_cmd, parse_ast_dump)
+                deps.update(os.path.abspath(dep) for dep in read_depfile(depfile))
 
-    ast = parse_ast_dump(output.stdout.decode())
+        if cache_path is not None:
+            save_cached_ast(cache_path, ast, deps)
 
     if args.verbose:
         print(f'{"="*80}\n  AST\n{"="*80}\n{ast}')
@@ -302,17 +735,8 @@ def main():
     if args.verbose:
         print(f'{"="*80}\n  Wrapper Python code\n{"="*80}\n{py_code}')
 
-    if args.verbose:
-        print(f'Creating {cpp_filename}')
-    
-    with open(cpp_filename, 'w') as f:
-        f.write(cpp_code)
-
-    if args.verbose:
-        print(f'Creating {py_filename}')
-        
-    with open(py_filename, 'w') as f:
-        f.write(py_code)
+    write_if_changed(cpp_filename, cpp_code, verbose=args.verbose)
+    write_if_changed(py_filename, py_code, verbose=args.verbose)
 
     if args.build:
         clang_build_cmd = [args.clang_exe] + args.clang_build_flags.split() + args.clang_extra_flags.split() + source_files + ['-o', shared_library_filename]